@@ -0,0 +1,139 @@
+import asyncio
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+from fastapi import HTTPException
+from pydantic import BaseModel
+
+from meritrank_service.log import LOGGER
+
+LOGGER = LOGGER.getChild("admission")
+
+# Monotonic time by which the current computation must finish
+current_deadline: ContextVar[float | None] = ContextVar("current_deadline", default=None)
+
+
+class AdmissionError(HTTPException):
+    def __str__(self) -> str:
+        # Used as the message of GraphQL errors
+        return self.detail
+
+
+class Overloaded(AdmissionError):
+    def __init__(self, operation: str) -> None:
+        super().__init__(429, f"Too many {operation} requests waiting, try again later",
+                         headers={"Retry-After": "1"})
+
+
+class DeadlineExceeded(AdmissionError):
+    def __init__(self) -> None:
+        super().__init__(503, "Request deadline exceeded, try again later",
+                         headers={"Retry-After": "1"})
+
+
+def check_deadline():
+    """
+    Abort the current computation if its deadline has passed.
+    Long-running computations should call this periodically.
+    """
+    if (deadline := current_deadline.get()) is not None and time.monotonic() > deadline:
+        raise DeadlineExceeded()
+
+
+class OperationLimit(BaseModel):
+    # Maximum number of admitted computations. The computations of the rank are serialized,
+    # so only one of them is running, while the rest are waiting for the rank lock.
+    max_concurrent: int = 1
+    # Maximum number of requests waiting for their turn. Requests beyond it are rejected.
+    max_queue: int = 16
+    # Seconds for the request to wait in the queue and finish the computation
+    timeout: float = 10.0
+
+
+DEFAULT_OPERATION_LIMITS = {
+    "ranks": OperationLimit(max_concurrent=4, max_queue=64, timeout=10.0),
+    "users_stats": OperationLimit(max_concurrent=2, max_queue=16, timeout=20.0),
+    "gravity_graph": OperationLimit(max_concurrent=2, max_queue=32, timeout=10.0),
+    "calculate": OperationLimit(max_concurrent=1, max_queue=8, timeout=60.0),
+    "refresh_zero_opinion": OperationLimit(max_concurrent=1, max_queue=1, timeout=600.0),
+    # Lookups are cheap for the calculated egos, but still wait for the rank lock,
+    # so those are limited too, to bound the number of worker threads waiting for it
+    "node_score": OperationLimit(max_concurrent=4, max_queue=256, timeout=10.0),
+    "node_scores": OperationLimit(max_concurrent=2, max_queue=32, timeout=20.0),
+    "node_edges": OperationLimit(max_concurrent=4, max_queue=256, timeout=10.0),
+}
+
+# Seconds for the computations of the operations without a configured limit to finish
+DEFAULT_TIMEOUT = 60.0
+
+
+class AdmissionControl:
+    """
+    Limits the number of concurrently running and waiting expensive operations,
+    and sets the deadline for each admitted computation. The operations without
+    a configured limit are admitted unconditionally, with the default deadline.
+    """
+
+    def __init__(self, limits: dict[str, OperationLimit] = None, default_timeout: float = DEFAULT_TIMEOUT) -> None:
+        self.__limits = DEFAULT_OPERATION_LIMITS if limits is None else limits
+        self.__default_timeout = default_timeout
+        self.__semaphores = {operation: asyncio.Semaphore(limit.max_concurrent)
+                             for operation, limit in self.__limits.items()}
+        self.__waiting = Counter()
+        self.admitted = Counter()
+        self.rejected = Counter()
+        self.timed_out = Counter()
+
+    @asynccontextmanager
+    async def admit(self, operation: str):
+        if (limit := self.__limits.get(operation)) is None:
+            # Still not waiting for the rank lock forever
+            token = current_deadline.set(time.monotonic() + self.__default_timeout)
+            try:
+                yield
+            finally:
+                current_deadline.reset(token)
+            return
+
+        deadline = time.monotonic() + limit.timeout
+        semaphore = self.__semaphores[operation]
+        if not semaphore.locked():
+            # Acquiring a free semaphore does not wait
+            await semaphore.acquire()
+        else:
+            if self.__waiting[operation] >= limit.max_queue:
+                LOGGER.warning("Rejecting %s request: queue is full", operation)
+                self.rejected[operation] += 1
+                raise Overloaded(operation)
+            self.__waiting[operation] += 1
+            try:
+                await asyncio.wait_for(semaphore.acquire(), limit.timeout)
+            except asyncio.TimeoutError:
+                LOGGER.warning("Timed out %s request waiting in queue", operation)
+                self.timed_out[operation] += 1
+                raise DeadlineExceeded()
+            finally:
+                self.__waiting[operation] -= 1
+
+        self.admitted[operation] += 1
+        token = current_deadline.set(deadline)
+        try:
+            yield
+        except DeadlineExceeded:
+            LOGGER.warning("Aborted %s computation after deadline", operation)
+            self.timed_out[operation] += 1
+            raise
+        finally:
+            current_deadline.reset(token)
+            semaphore.release()
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {
+            operation: {"admitted": self.admitted[operation],
+                        "waiting": self.__waiting[operation],
+                        "rejected": self.rejected[operation],
+                        "timed_out": self.timed_out[operation]}
+            for operation in self.__limits
+        }
@@ -1,15 +1,20 @@
 import asyncio
+from functools import partial
 
 from fastapi import FastAPI
 
 from meritrank_service import __version__ as meritrank_service_version
 
+from meritrank_service.admission import AdmissionControl
 from meritrank_service.graphql import get_graphql_app
 from meritrank_service.gravity_rank import GravityRank
 from meritrank_service.log import LOGGER
 from meritrank_service.postgres_edges_updater import create_notification_listener
-from meritrank_service.rest import MeritRankRestRoutes
+from meritrank_service.profiling import Profiler, ProfilingMiddleware
+from meritrank_service.rest import MeritRankRestRoutes, log_task_exception
+from meritrank_service.score_notifier import ScoreChangeNotifier
 from meritrank_service.settings import MeritRankSettings
+from meritrank_service.single_flight import SingleFlight
 
 
 def create_meritrank_app():
@@ -23,14 +28,39 @@ def create_meritrank_app():
         edges_data = get_edges_data(settings.pg_dsn)
         LOGGER.info("Loaded edges from DB")
 
+    cluster = None
+    if settings.cluster_shard:
+        from meritrank_service.cluster import ClusterShard, HashRing
+        LOGGER.info("Starting as cluster shard %s", settings.cluster_shard)
+        cluster = ClusterShard(HashRing(settings.cluster_shards), settings.cluster_shard)
+
     LOGGER.info("Creating meritrank instance")
-    rank_instance = GravityRank(graph=edges_data, logger=LOGGER.getChild("meritrank"), num_walks=settings.walk_count)
-    user_routes = MeritRankRestRoutes(rank_instance)
+    rank_instance = GravityRank(graph=edges_data, logger=LOGGER.getChild("meritrank"), num_walks=settings.walk_count,
+                                owns_ego=cluster.owns_ego if cluster else None)
+    # Shared between REST and GraphQL, so identical computations are coalesced across both
+    single_flight = SingleFlight(AdmissionControl(settings.operation_limits))
+    profiler = Profiler()
+    user_routes = MeritRankRestRoutes(rank_instance, single_flight, max_walk_count=settings.max_walk_count,
+                                      profiler=profiler)
+
+    scores_exporter = None
+    if settings.score_export:
+        from meritrank_service.postgres_scores_exporter import PostgresScoresExporter
+        scores_exporter = PostgresScoresExporter(
+            rank_instance,
+            single_flight,
+            settings.pg_dsn,
+            top_nodes_limit=settings.score_export_top_nodes_limit,
+            batch_size=settings.score_export_batch_size,
+            batch_pause=settings.score_export_batch_pause)
 
     LOGGER.info("Creating FastAPI instance")
     app = FastAPI(title="MeritRank", version=meritrank_service_version)
+    app.add_middleware(ProfilingMiddleware, profiler=profiler)
     app.include_router(user_routes.router)
-    app.include_router(get_graphql_app(rank_instance), prefix="/graphql")
+    app.include_router(get_graphql_app(
+        rank_instance, single_flight, cluster,
+        ScoreChangeNotifier(rank_instance, debounce=settings.subscription_debounce)), prefix="/graphql")
     LOGGER.info("Returning app instance")
 
     @app.on_event("startup")
@@ -42,25 +72,35 @@ def create_meritrank_app():
                 create_notification_listener(
                     settings.pg_dsn,
                     settings.pg_edges_channel,
-                    rank_instance.add_edge))
+                    partial(single_flight.run, rank_instance.add_edge)))
 
             async def warmup_into_zero():
                 if settings.zero_node:
                     LOGGER.info("Scheduling zero heartbeat to start after warmup")
                 if settings.ego_warmup:
                     LOGGER.info("Scheduling ego warmup")
-                    await rank_instance.warmup(settings.ego_warmup_wait)
+                    await rank_instance.warmup(single_flight, settings.ego_warmup_wait)
                 if settings.zero_node:
                     await rank_instance.zero_opinion_heartbeat(
+                        single_flight,
                         settings.zero_node,
                         settings.zero_top_nodes_limit,
                         settings.zero_heartbeat_period)
 
             app.state.ego_warmup_task = asyncio.create_task(warmup_into_zero())
+            app.state.ego_warmup_task.add_done_callback(log_task_exception)
+
+        if scores_exporter:
+            LOGGER.info("Starting scores export to Postgres")
+            app.state.scores_export_task = asyncio.create_task(
+                scores_exporter.run(settings.score_export_period))
 
 
     @app.on_event("shutdown")
     async def shutdown_event():
+        if getattr(app.state, "scores_export_task", None):
+            LOGGER.info("Stopping scores export to Postgres")
+            app.state.scores_export_task.cancel()
         if app.state.ego_warmup_task and app.state.ego_warmup_task.running():
             LOGGER.info("Warmup task still running, cancelling")
             app.state.ego_warmup_task.cancel()
@@ -0,0 +1,112 @@
+import asyncio
+import bisect
+import hashlib
+import time
+
+import httpx
+from fastapi import HTTPException
+from meritrank_python.rank import NodeId
+
+from meritrank_service.admission import DEFAULT_TIMEOUT, DeadlineExceeded, check_deadline, current_deadline
+from meritrank_service.log import LOGGER
+
+LOGGER = LOGGER.getChild("cluster")
+
+
+class NotEgoOwner(HTTPException):
+    def __init__(self, ego: NodeId) -> None:
+        super().__init__(421, f"Ego {ego} is owned by another shard")
+
+    def __str__(self) -> str:
+        return self.detail
+
+
+class ShardUnavailable(HTTPException):
+    def __init__(self, shard: str) -> None:
+        super().__init__(503, f"Shard {shard} is unavailable, try again later",
+                         headers={"Retry-After": "1"})
+
+    def __str__(self) -> str:
+        return self.detail
+
+
+def stable_hash(key: str) -> int:
+    # Python's hash() is randomized per process, so it can't be used to agree on owners
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring assigning egos to shards. Each shard is placed
+    on the ring multiple times (replicas) to even out the partitions.
+    """
+
+    def __init__(self, shards: list[str], replicas: int = 100) -> None:
+        if not shards:
+            raise ValueError("Hash ring requires at least one shard")
+        self.shards = list(shards)
+        ring = sorted((stable_hash(f"{shard}#{i}"), shard) for shard in shards for i in range(replicas))
+        self.__hashes = [h for h, _ in ring]
+        self.__shards = [shard for _, shard in ring]
+
+    def owner(self, ego: NodeId) -> str:
+        pos = bisect.bisect(self.__hashes, stable_hash(ego)) % len(self.__hashes)
+        return self.__shards[pos]
+
+
+class ClusterShard:
+    """
+    A service instance owning the partition of egos assigned to it by the hash ring.
+    Requests touching the egos of other shards are sent to their owners.
+    """
+
+    def __init__(self, ring: HashRing, shard: str, clients: dict[str, httpx.AsyncClient] = None) -> None:
+        if shard not in ring.shards:
+            raise ValueError(f"Shard {shard} is not in the cluster shards {ring.shards}")
+        self.ring = ring
+        self.shard = shard
+        if clients is None:
+            clients = {s: httpx.AsyncClient(base_url=s) for s in ring.shards if s != shard}
+        self.__clients = clients
+
+    def owns_ego(self, ego: NodeId) -> bool:
+        return self.ring.owner(ego) == self.shard
+
+    async def __get_remote_node_scores(self, shard, node, egos) -> dict[NodeId, float]:
+        # Don't wait for the other shard past the deadline of the computation
+        timeout = DEFAULT_TIMEOUT
+        if (deadline := current_deadline.get()) is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise DeadlineExceeded()
+        try:
+            response = await self.__clients[shard].post(f"/node_scores/{node}", json=egos, timeout=timeout)
+            response.raise_for_status()
+        except httpx.TimeoutException as e:
+            LOGGER.warning("Timed out requesting scores of %s from shard %s", node, shard)
+            raise DeadlineExceeded() from e
+        except httpx.HTTPError as e:
+            LOGGER.warning("Failed to get scores of %s from shard %s: %s", node, shard, repr(e))
+            raise ShardUnavailable(shard) from e
+        return {s["ego"]: s["score"] for s in response.json()}
+
+    async def get_node_scores(self, rank, single_flight, node: NodeId, egos: list[NodeId]) -> dict[NodeId, float]:
+        """
+        Get the scores of the node from the perspective of each of the given egos,
+        asking the shards owning the egos.
+        """
+        egos_by_owner = {}
+        for ego in egos:
+            egos_by_owner.setdefault(self.ring.owner(ego), []).append(ego)
+
+        scores = {}
+        for ego in egos_by_owner.pop(self.shard, []):
+            # Take the rank lock for one ego at a time, as the walks of each ego may be calculated
+            check_deadline()
+            scores[ego] = await single_flight.run(rank.get_node_score, ego, node)
+        LOGGER.debug("Requesting scores of %s from %i shards", node, len(egos_by_owner))
+        for remote_scores in await asyncio.gather(
+                *(self.__get_remote_node_scores(shard, node, shard_egos)
+                  for shard, shard_egos in egos_by_owner.items())):
+            scores.update(remote_scores)
+        return scores
@@ -0,0 +1,202 @@
+import asyncio
+import itertools
+import json
+
+import httpx
+from fastapi import FastAPI, Request, Response, WebSocket
+from graphql import parse, GraphQLError, OperationDefinitionNode, FieldNode, OperationType
+from graphql.utilities import value_from_ast_untyped
+
+from meritrank_service import __version__ as meritrank_service_version
+from meritrank_service.cluster import HashRing
+from meritrank_service.log import LOGGER
+from meritrank_service.persisted_queries import PersistedQueries, PersistedQueryError, get_persisted_query_hash
+from meritrank_service.settings import MeritRankSettings
+
+LOGGER = LOGGER.getChild("cluster_router")
+
+# Paths of the first-level REST resources scoped by the ego given as the next path element
+EGO_SCOPED_PATHS = {"scores", "node_score"}
+# The global ranking needs the walks of all the egos, so it can't be served by a single shard
+UNSUPPORTED_PATHS = {"zero", "global_ranking", "graph"}
+
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "upgrade",
+                      "host", "content-length", "content-encoding"}
+
+
+def filter_headers(headers) -> dict[str, str]:
+    return {k: v for k, v in headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+
+
+def get_graphql_request_data(request: Request, body: bytes) -> dict:
+    if request.method == "GET":
+        data = dict(request.query_params)
+        for key in ("variables", "extensions"):
+            if isinstance(data.get(key), str):
+                data[key] = json.loads(data[key])
+        return data
+    return json.loads(body or b"{}")
+
+
+def get_graphql_egos(data: dict) -> tuple[bool, set[str]]:
+    """
+    Returns whether the GraphQL request is a mutation, and the set of egos
+    given as the "ego" argument to the top-level fields of the operation.
+    """
+    variables = data.get("variables") or {}
+    if (query := data.get("query")) is None:
+        # Let a shard report the missing query
+        return False, set()
+
+    is_mutation, egos = False, set()
+    for definition in parse(query).definitions:
+        if not isinstance(definition, OperationDefinitionNode):
+            continue
+        if (operation_name := data.get("operationName")) and (
+                definition.name is None or definition.name.value != operation_name):
+            continue
+        is_mutation = is_mutation or definition.operation == OperationType.MUTATION
+        for selection in definition.selection_set.selections:
+            if not isinstance(selection, FieldNode):
+                continue
+            for argument in selection.arguments:
+                if argument.name.value == "ego" and isinstance(
+                        ego := value_from_ast_untyped(argument.value, variables), str):
+                    egos.add(ego)
+    return is_mutation, egos
+
+
+def graphql_error_response(status_code: int, message: str, extensions: dict = None) -> Response:
+    error = {"message": message}
+    if extensions:
+        error["extensions"] = extensions
+    return Response(status_code=status_code, media_type="application/json",
+                    content=json.dumps({"data": None, "errors": [error]}))
+
+
+class ClusterRouter:
+    """
+    A thin front end for the cluster: forwards the requests scoped by an ego
+    to the shard owning it, sends the updates (e.g. new edges) to all the shards,
+    and balances the rest of the requests between the shards.
+    """
+
+    def __init__(self, shards: list[str], clients: dict[str, httpx.AsyncClient] = None,
+                 persisted_queries_limit: int = 1000) -> None:
+        self.ring = HashRing(shards)
+        # The shards each have their own persisted queries, so the router expands the persisted
+        # queries itself, to route them by their egos and not depend on the shard's store
+        self.__persisted_queries = PersistedQueries(persisted_queries_limit)
+        if clients is None:
+            clients = {s: httpx.AsyncClient(base_url=s, timeout=None) for s in shards}
+        self.__clients = clients
+        self.__next_shard = itertools.cycle(shards)
+
+    async def forward(self, shard: str, request: Request, body: bytes, json_data: dict = None) -> Response:
+        LOGGER.debug("Forwarding %s %s to %s", request.method, request.url.path, shard)
+        if json_data is None:
+            response = await self.__clients[shard].request(
+                request.method, request.url.path,
+                params=request.query_params, content=body, headers=filter_headers(request.headers))
+        else:
+            # The request rewritten by the router is sent as a POST with the JSON body
+            headers = {k: v for k, v in filter_headers(request.headers).items() if k.lower() != "content-type"}
+            response = await self.__clients[shard].post(request.url.path, json=json_data, headers=headers)
+        return Response(content=response.content, status_code=response.status_code,
+                        headers=filter_headers(response.headers))
+
+    async def forward_to_owner(self, ego: str, request: Request, body: bytes) -> Response:
+        return await self.forward(self.ring.owner(ego), request, body)
+
+    async def forward_to_any(self, request: Request, body: bytes, json_data: dict = None) -> Response:
+        return await self.forward(next(self.__next_shard), request, body, json_data)
+
+    async def fan_out(self, request: Request, body: bytes, json_data: dict = None) -> Response:
+        responses = await asyncio.gather(*(self.forward(shard, request, body, json_data)
+                                           for shard in self.ring.shards))
+        # Report the first failure, if there is one
+        return next((r for r in responses if r.status_code >= 400), responses[0])
+
+    async def node_scores(self, node: str, request: Request, body: bytes) -> Response:
+        egos_by_owner = {}
+        for ego in json.loads(body):
+            egos_by_owner.setdefault(self.ring.owner(ego), []).append(ego)
+        scores = []
+        for shard, egos in egos_by_owner.items():
+            response = await self.__clients[shard].post(f"/node_scores/{node}", json=egos)
+            if response.status_code >= 400:
+                return Response(content=response.content, status_code=response.status_code)
+            scores.extend(response.json())
+        return Response(content=json.dumps(scores), media_type="application/json")
+
+    async def route_rest(self, request: Request, path: str) -> Response:
+        body = await request.body()
+        parts = path.strip("/").split("/")
+        if parts[0] in UNSUPPORTED_PATHS:
+            return Response(status_code=501, content=f"/{parts[0]} is not supported in cluster mode")
+        if parts[0] in EGO_SCOPED_PATHS and len(parts) > 1:
+            return await self.forward_to_owner(parts[1], request, body)
+        if parts[0] == "calculate" and (ego := request.query_params.get("ego")) is not None:
+            return await self.forward_to_owner(ego, request, body)
+        if parts[0] == "node_scores" and len(parts) > 1 and request.method == "POST":
+            return await self.node_scores(parts[1], request, body)
+        if request.method != "GET":
+            return await self.fan_out(request, body)
+        return await self.forward_to_any(request, body)
+
+    async def route_graphql(self, request: Request) -> Response:
+        body = await request.body()
+        json_data = None
+        try:
+            data = get_graphql_request_data(request, body)
+            if (sha256_hash := get_persisted_query_hash(data)) is not None:
+                if data.get("query") is None:
+                    # Send the expanded query, as the shard might not know the hash
+                    json_data = data
+                data["query"] = self.__persisted_queries.resolve(data.get("query"), sha256_hash)
+            is_mutation, egos = get_graphql_egos(data)
+        except PersistedQueryError as e:
+            return graphql_error_response(200, str(e), {"code": e.code})
+        except (GraphQLError, ValueError) as e:
+            # Let a shard report the malformed request
+            LOGGER.debug("Could not get egos from GraphQL request: %s", e)
+            return await self.forward_to_any(request, body)
+
+        if is_mutation:
+            return await self.fan_out(request, body, json_data)
+        owners = {self.ring.owner(ego) for ego in egos}
+        if len(owners) > 1:
+            return graphql_error_response(
+                400, "Fields for egos owned by different shards must be sent in separate requests")
+        if owners:
+            return await self.forward(owners.pop(), request, body, json_data)
+        return await self.forward_to_any(request, body, json_data)
+
+
+def create_cluster_router_app(clients: dict[str, httpx.AsyncClient] = None):
+    settings = MeritRankSettings()
+    LOGGER.setLevel(settings.log_level)
+    LOGGER.info("Creating cluster router for shards %s", settings.cluster_shards)
+    router = ClusterRouter(settings.cluster_shards, clients)
+
+    app = FastAPI(title="MeritRank cluster router", version=meritrank_service_version)
+
+    @app.get("/healthcheck")
+    async def healthcheck():
+        return {"status": "ok"}
+
+    @app.api_route("/graphql", methods=["GET", "POST"])
+    async def graphql(request: Request):
+        return await router.route_graphql(request)
+
+    @app.websocket("/graphql")
+    async def graphql_subscriptions(websocket: WebSocket):
+        # Subscriptions must be sent directly to the shard owning the ego
+        LOGGER.debug("Rejecting GraphQL subscription: not supported by the router")
+        await websocket.close(code=1008, reason="Subscriptions are not supported by the cluster router")
+
+    @app.api_route("/{path:path}", methods=["GET", "PUT", "POST"])
+    async def rest(request: Request, path: str):
+        return await router.route_rest(request, path)
+
+    return app
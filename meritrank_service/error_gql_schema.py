@@ -3,6 +3,8 @@ import traceback
 import strawberry
 from graphql import GraphQLError, ExecutionContext
 
+from fastapi import HTTPException
+
 from meritrank_service.log import LOGGER
 
 
@@ -16,6 +18,13 @@ class ErrorEnabledSchema(strawberry.Schema):
 
         for error in errors:
             err = getattr(error, "original_error")
-            if err:
+            if isinstance(err, HTTPException):
+                # Expected errors, such as overload, are reported with the HTTP status,
+                # so the clients could back off
+                if execution_context and (response := getattr(execution_context.context, "response", None)):
+                    response.status_code = err.status_code
+                    response.headers.update(err.headers or {})
+                LOGGER.warning("GraphQL request failed: %s", err.detail)
+            elif err:
                 tb_str = "".join(traceback.format_exception(type(err), err, err.__traceback__))
                 LOGGER.error(tb_str)
@@ -1,3 +1,4 @@
+from datetime import datetime
 from typing import List, Optional
 
 import strawberry
@@ -10,6 +11,14 @@ class NodeScore:
     score: float
 
 
+@strawberry.type
+class ScoresColumns:
+    ego: str
+    # Nodes and their scores, at the same positions
+    nodes: List[str]
+    scores: List[float]
+
+
 @strawberry.type
 class Edge:
     src: str
@@ -30,3 +39,30 @@ class GravityGraph:
     users: List[Optional[NodeScore]]
     beacons: List[Optional[NodeScore]]
     comments: List[Optional[NodeScore]]
+
+
+@strawberry.type
+class ScoreUpdate:
+    ego: str
+    # New and changed scores among the top scores of the ego
+    scores: List[NodeScore]
+    # Nodes that dropped out of the top scores
+    removed: List[str]
+
+
+@strawberry.type
+class GlobalRank:
+    node: str
+    score: float
+
+
+@strawberry.type
+class GlobalRankingPage:
+    version: int
+    updated_at: datetime
+    total: int
+    offset: int
+    # True if the version is the same as the known version given in the query.
+    # In that case, ranks are not returned.
+    not_modified: bool
+    ranks: List[GlobalRank]
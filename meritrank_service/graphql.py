@@ -1,27 +1,36 @@
+import asyncio
+from datetime import datetime, timezone
 from functools import wraps
-from typing import Optional
+from typing import AsyncGenerator, Optional
 
 import strawberry
 from fastapi import Depends
 from meritrank_python.rank import IncrementalMeritRank, NodeDoesNotExist, EgoNotInitialized, EgoCounterEmpty
 from strawberry import UNSET
+from strawberry.extensions import ParserCache, ValidationCache
 
-from strawberry.fastapi import GraphQLRouter, BaseContext
+from strawberry.fastapi import BaseContext
 from strawberry.types import Info
 
+from meritrank_service.cluster import ClusterShard
 from meritrank_service.error_gql_schema import ErrorEnabledSchema
-from meritrank_service.gql_types import Edge, NodeScore, GravityGraph, MutualScore
+from meritrank_service.gql_types import Edge, NodeScore, GravityGraph, MutualScore, GlobalRank, \
+    GlobalRankingPage, ScoreUpdate, ScoresColumns
 from meritrank_service.gravity_rank import GravityRank
 from meritrank_service.log import LOGGER
+from meritrank_service.persisted_queries import PersistedQueriesRouter
+from meritrank_service.profiling import ProfilingExtension, stage
+from meritrank_service.score_notifier import ScoreChangeNotifier, diff_scores
+from meritrank_service.single_flight import SingleFlight
 
 
 def handle_exceptions(func):
     @wraps(func)
-    def wrapper(*args, **kwargs):
+    async def wrapper(*args, **kwargs):
         args_str = ', '.join(str(arg) for arg in args)
         kwargs_str = ', '.join(f'{k}={str(v)}' for k, v in kwargs.items() if k != "info")
         try:
-            return func(*args, **kwargs)
+            return await func(*args, **kwargs)
         except NodeDoesNotExist as e:
             LOGGER.warning('GQL query "%s" exception: node %s does not exist. args %s, kwargs %s', func.__name__,
                            e.node, args_str, kwargs_str)
@@ -82,6 +91,17 @@ LOGGER = LOGGER.getChild("graphql")
 def ego_score_dict_to_list(ego, d):
     return [NodeScore(node=n, ego=ego, score=s) for n, s in d.items()]
 
+def filter_scores(mr, ego, ranks, where, hide_personal):
+    for node, score in ranks.items():
+        if where is not UNSET and not where.match(node, score):
+            continue
+        if (hide_personal
+                and (node.startswith("C") or node.startswith("B"))
+                and mr.get_edge(node, ego)):
+            continue
+        yield node, score
+
+
 def demux_nodes(nodes_dict):
     users, beacons, comments = {}, {}, {}
     for node, score in nodes_dict.items():
@@ -105,91 +125,194 @@ class Query:
         return None
 
     @strawberry.field
-    def edges(self, info: Info, src: str) -> list[Edge]:
-        return [Edge(src=e[0], dest=e[1], weight=e[2]) for e in info.context.mr.get_node_edges(src)]
+    async def edges(self, info: Info, src: str) -> list[Edge]:
+        edges = await info.context.single_flight.do(("node_edges", src), info.context.mr.get_node_edges, src)
+        return [Edge(src=e[0], dest=e[1], weight=e[2]) for e in edges]
 
     @strawberry.field
     @handle_exceptions
-    def score(self, info, ego: str, node: str) -> Optional[NodeScore]:
-        score = info.context.mr.get_node_score(ego, node)
+    async def score(self, info, ego: str, node: str) -> Optional[NodeScore]:
+        score = await info.context.single_flight.do(
+            ("node_score", ego, node), info.context.mr.get_node_score, ego, node)
         return NodeScore(node=node, ego=ego, score=score)
 
     @strawberry.field
-    def scores(self, info, ego: str,
-               where: Optional[NodeScoreWhereInput] = UNSET,
-               limit: Optional[int] = UNSET,
-               hide_personal: Optional[bool] = UNSET
-               ) -> list[NodeScore]:
-        result = []
-        for node, score in info.context.mr.get_ranks(ego, limit=limit or None).items():
-            if where is not UNSET and not where.match(node, score):
-                continue
-            if (hide_personal
-                    and (node.startswith("C") or node.startswith("B"))
-                    and info.context.mr.get_edge(node, ego)):
-                continue
-
-            try:
-                result.append(NodeScore(node=node, ego=ego, score=score))
-            except NodeDoesNotExist:
-                self.logger.warning('GQL query "score" exception: node %s does not exist.', node)
-        return result
+    async def scores(self, info, ego: str,
+                     where: Optional[NodeScoreWhereInput] = UNSET,
+                     limit: Optional[int] = UNSET,
+                     hide_personal: Optional[bool] = UNSET
+                     ) -> list[NodeScore]:
+        ranks = await info.context.single_flight.do(
+            ("ranks", ego, limit or None), info.context.mr.get_ranks, ego, limit=limit or None)
+        with stage("graphql.build"):
+            return [NodeScore(node=node, ego=ego, score=score)
+                    for node, score in filter_scores(info.context.mr, ego, ranks, where, hide_personal)]
+
+    @strawberry.field
+    async def scores_columns(self, info, ego: str,
+                             where: Optional[NodeScoreWhereInput] = UNSET,
+                             limit: Optional[int] = UNSET,
+                             hide_personal: Optional[bool] = UNSET
+                             ) -> ScoresColumns:
+        """
+        The same scores as the scores field, as two lists of nodes and scores.
+        Lists of scalars are much cheaper to build and serialize than lists of objects,
+        so this is preferred for the egos with many scored nodes.
+        """
+        ranks = await info.context.single_flight.do(
+            ("ranks", ego, limit or None), info.context.mr.get_ranks, ego, limit=limit or None)
+        if where is UNSET and not hide_personal:
+            return ScoresColumns(ego=ego, nodes=list(ranks), scores=list(ranks.values()))
+        scores = dict(filter_scores(info.context.mr, ego, ranks, where, hide_personal))
+        return ScoresColumns(ego=ego, nodes=list(scores), scores=list(scores.values()))
 
     @strawberry.field
-    def gravity_graph(self, info, ego: str,
-                      focus: Optional[str] = UNSET,
-                      positive_only: Optional[bool] = UNSET,
-                      limit: Optional[int] = UNSET
-                      ) -> GravityGraph:
+    async def gravity_graph(self, info, ego: str,
+                            focus: Optional[str] = UNSET,
+                            positive_only: Optional[bool] = UNSET,
+                            limit: Optional[int] = UNSET
+                            ) -> GravityGraph:
         """
         This handle returns a graph of user's connections to other users.
         The graph is specific to usage in the Gravity/A2 social network.
         """
         LOGGER.info("Getting gravity graph (%s, include_negative=%s)", ego, "True" if positive_only else "False")
-        edges, nodes_dict = info.context.mr.gravity_graph(
-            ego, focus or ego,
-            positive_only if positive_only is not UNSET else True,
-            limit if limit is not UNSET else None
-        )
-        users, beacons, comments = demux_nodes(nodes_dict)
-        return GravityGraph(
-            edges=edges,
-            users=ego_score_dict_to_list(ego, users),
-            beacons=ego_score_dict_to_list(ego, beacons),
-            comments=ego_score_dict_to_list(ego, comments)
-        )
+        args = (ego, focus or ego,
+                positive_only if positive_only is not UNSET else True,
+                limit if limit is not UNSET else None)
+        edges, nodes_dict = await info.context.single_flight.do(
+            ("gravity_graph", *args), info.context.mr.gravity_graph, *args)
+        with stage("graphql.build"):
+            users, beacons, comments = demux_nodes(nodes_dict)
+            return GravityGraph(
+                edges=edges,
+                users=ego_score_dict_to_list(ego, users),
+                beacons=ego_score_dict_to_list(ego, beacons),
+                comments=ego_score_dict_to_list(ego, comments)
+            )
 
     @strawberry.field
-    def users_stats(self, info, ego: str) -> list[MutualScore]:
+    async def users_stats(self, info, ego: str) -> list[MutualScore]:
         LOGGER.info("Getting users stats for user %s", ego)
-        stats_dict  = info.context.mr.get_users_stats(ego)
-        return [MutualScore(ego=ego, node=k, node_score=v[0], ego_score=v[1]) for k,v in stats_dict.items()]
+        mr, single_flight = info.context.mr, info.context.single_flight
+        if (cluster := info.context.cluster) is not None:
+            async def get_users_stats():
+                # The reverse scores come from the egos owned by the other shards
+                positive_users = await single_flight.run(mr.get_positive_users, ego)
+                reverse_scores = await cluster.get_node_scores(mr, single_flight, ego, list(positive_users))
+                return await single_flight.run(mr.get_users_stats, ego, reverse_scores, positive_users)
+
+            stats_dict = await single_flight.do(("users_stats", ego), get_users_stats)
+        else:
+            stats_dict = await single_flight.do(("users_stats", ego), mr.get_users_stats, ego)
+        with stage("graphql.build"):
+            return [MutualScore(ego=ego, node=k, node_score=v[0], ego_score=v[1]) for k,v in stats_dict.items()]
+
+    @strawberry.field
+    def global_ranking(self, info,
+                       offset: Optional[int] = UNSET,
+                       limit: Optional[int] = UNSET,
+                       known_version: Optional[int] = UNSET
+                       ) -> Optional[GlobalRankingPage]:
+        """
+        Returns a page of the latest global beacons ranking, or null if it was not calculated yet.
+        If known_version is equal to the current version, the ranks are not returned.
+        """
+        offset = offset or 0
+        limit = limit if limit is not UNSET else 100
+        if offset < 0:
+            raise ValueError("Offset must not be negative")
+        if limit < 1:
+            raise ValueError("Limit must be positive")
+        if (ranking := info.context.mr.global_ranking) is None:
+            return None
+        not_modified = known_version is not UNSET and known_version == ranking.version
+        return GlobalRankingPage(
+            version=ranking.version,
+            updated_at=datetime.fromtimestamp(ranking.updated_at, tz=timezone.utc),
+            total=len(ranking.ranks),
+            offset=offset,
+            not_modified=not_modified,
+            ranks=[] if not_modified else
+            [GlobalRank(node=n, score=s) for n, s in ranking.ranks[offset:offset + limit]]
+        )
 
 @strawberry.type
 class Mutation:
     @strawberry.mutation
-    def put_edge(self, info: Info, src: str, dest: str, weight: float) -> Edge:
-        info.context.mr.add_edge(src, dest, weight)
+    async def put_edge(self, info: Info, src: str, dest: str, weight: float) -> Edge:
+        await info.context.single_flight.run(info.context.mr.add_edge, src, dest, weight)
         LOGGER.info("Added edge: (%s, %s, %f)", src, dest, weight)
         return Edge(src=src, dest=dest, weight=weight)
 
 
+@strawberry.type
+class Subscription:
+    @strawberry.subscription
+    async def score_updates(self, info, ego: str,
+                            limit: Optional[int] = UNSET,
+                            threshold: Optional[float] = UNSET
+                            ) -> AsyncGenerator[ScoreUpdate, None]:
+        """
+        Pushes the changes of the ego's top scores. The first update contains all the top scores,
+        the following ones only the scores that changed by at least the threshold since they were sent.
+        Edge changes are debounced, and the changes not affecting the ego produce no updates.
+        """
+        limit = limit or 100
+        threshold = threshold if threshold is not UNSET else 0.001
+        if (notifier := info.context.score_notifier) is None:
+            raise ValueError("Score updates are not enabled")
+        with notifier.subscribe(ego) as scores_changed:
+            sent = {}
+            while True:
+                ranks = await info.context.single_flight.do(
+                    ("ranks", ego, limit), info.context.mr.get_ranks, ego, limit=limit)
+                changed, removed = diff_scores(sent, ranks, threshold)
+                if changed or removed:
+                    for node in removed:
+                        del sent[node]
+                    sent.update(changed)
+                    yield ScoreUpdate(ego=ego, scores=ego_score_dict_to_list(ego, changed), removed=removed)
+
+                await scores_changed.wait()
+                # Let the burst of edge changes settle before recalculating the scores
+                await asyncio.sleep(notifier.debounce)
+                scores_changed.clear()
+
+
 class CustomContext(BaseContext):
-    def __init__(self, rank: IncrementalMeritRank):
+    def __init__(self, rank: IncrementalMeritRank, single_flight: SingleFlight, cluster: ClusterShard = None,
+                 score_notifier: ScoreChangeNotifier = None):
         super().__init__()
         self.mr: IncrementalMeritRank = rank
+        self.single_flight: SingleFlight = single_flight
+        self.cluster: ClusterShard | None = cluster
+        self.score_notifier: ScoreChangeNotifier | None = score_notifier
+
+
+# The number of distinct query documents to keep parsed and validated
+DOCUMENT_CACHE_SIZE = 1000
 
+schema = ErrorEnabledSchema(Query, Mutation, Subscription, extensions=[
+    ParserCache(maxsize=DOCUMENT_CACHE_SIZE),
+    ValidationCache(maxsize=DOCUMENT_CACHE_SIZE),
+    ProfilingExtension,
+])
 
-schema = ErrorEnabledSchema(Query, Mutation)
 
+def get_graphql_app(rank: GravityRank, single_flight: SingleFlight = None, cluster: ClusterShard = None,
+                    score_notifier: ScoreChangeNotifier = None):
+    # The score notifier registers a listener on the rank, so it is created once by the caller.
+    # Without it, the score updates subscription is not available.
+    single_flight = single_flight or SingleFlight()
 
-def get_graphql_app(rank: GravityRank):
     def get_meritrank_instance():
-        return CustomContext(rank)
+        return CustomContext(rank, single_flight, cluster, score_notifier)
 
     async def get_context(custom_context=Depends(get_meritrank_instance)):
         return custom_context
 
-    graphql_app = GraphQLRouter(schema, context_getter=get_context)
+    graphql_app = PersistedQueriesRouter(schema, context_getter=get_context,
+                                         persisted_queries_limit=DOCUMENT_CACHE_SIZE)
     LOGGER.info("Created GraphQL router")
     return graphql_app
@@ -1,9 +1,14 @@
 import asyncio
+import time
+from dataclasses import dataclass
 
 from meritrank_python.lazy import LazyMeritRank
 from meritrank_python.rank import NodeId
 
+from meritrank_service.admission import AdmissionError, check_deadline, current_deadline
+from meritrank_service.cluster import NotEgoOwner
 from meritrank_service.gql_types import Edge
+from meritrank_service.profiling import profiled, stage
 import networkx as nx
 
 
@@ -30,33 +35,175 @@ def filter_dict_by_set(d, s):
     return {k: v for k, v in d.items() if k in s}
 
 
+@dataclass(frozen=True)
+class GlobalRanking:
+    # Incremented each time the ranking changes
+    version: int
+    # Unix time of the last change of the ranking
+    updated_at: float
+    ranks: list[tuple[NodeId, float]]
+
+
 class GravityRank(LazyMeritRank):
+    def __init__(self, *args, **kwargs) -> None:
+        # In cluster mode, the predicate telling if this instance owns the given ego.
+        # Walks are only ever calculated for the owned egos.
+        self.__owns_ego = kwargs.pop("owns_ego", None)
+        super().__init__(*args, **kwargs)
+        # Callbacks to notify about edge changes, called as
+        # callback(src, dest, weight, affected_egos)
+        self.__edge_listeners = []
+        # The latest global ranking calculated by refreshing the zero opinion
+        self.global_ranking: GlobalRanking | None = None
 
-    def get_top_beacons_global(self):
-        reduced_graph = nx.DiGraph()
-        for ego in self._IncrementalMeritRank__graph.nodes():
-            if not ego.startswith("U"):
-                continue
-            for dest, score in self.get_ranks(ego).items():
+    def owns_ego(self, ego: NodeId) -> bool:
+        return self.__owns_ego is None or self.__owns_ego(ego)
+
+    def __check_ego_owner(self, ego: NodeId):
+        if not self.owns_ego(ego):
+            raise NotEgoOwner(ego)
+
+    def calculate(self, ego: NodeId, num_walks: int = None):
+        self.__check_ego_owner(ego)
+        return super().calculate(ego, num_walks)
+
+    def __maybe_calculate(self, ego: NodeId):
+        self.__check_ego_owner(ego)
+        if ego not in self.egos:
+            # Do the lazy calculation explicitly, to time the walks separately
+            with stage("walks"):
+                super().calculate(ego)
+
+    @profiled("ranks")
+    def get_ranks(self, ego, *args, **kwargs):
+        self.__maybe_calculate(ego)
+        return super().get_ranks(ego, *args, **kwargs)
+
+    def get_node_score(self, ego, *args, **kwargs):
+        self.__maybe_calculate(ego)
+        return super().get_node_score(ego, *args, **kwargs)
+
+    def add_edge_listener(self, callback):
+        self.__edge_listeners.append(callback)
+
+    def get_egos_affected_by_node(self, node) -> set[NodeId]:
+        # Changing an outgoing edge of a node can only affect the egos
+        # whose walks go through that node (including the node itself)
+        walks = self._IncrementalMeritRank__walks.get_walks_through_node(node)
+        affected_egos = {pos_walk.walk[0] for pos_walk in walks.values()}
+        if node in self.egos:
+            affected_egos.add(node)
+        return affected_egos
+
+    def add_edge(self, src: NodeId, dest: NodeId, weight: float = 1.0):
+        if (self.get_edge(src, dest) or 0.0) == weight:
+            # Nothing changes, so don't bother the listeners
+            return super().add_edge(src, dest, weight)
+        affected_egos = self.get_egos_affected_by_node(src)
+        super().add_edge(src, dest, weight)
+        for callback in self.__edge_listeners:
+            callback(src, dest, weight, affected_egos)
+
+    def replace_graph(self, graph):
+        """
+        Replace the graph, dropping all the calculated walks. The instance is shared
+        by the routes and the background tasks, so it is reinitialized in place,
+        keeping the edge listeners, the cluster ownership and the global ranking.
+        The listeners are notified with all the previous egos affected, and no edge.
+        """
+        affected_egos = set(self.egos)
+        LazyMeritRank.__init__(self, graph, logger=self.logger, num_walks=self.num_walks)
+        for callback in self.__edge_listeners:
+            callback(None, None, None, affected_egos)
+
+    def get_user_nodes(self) -> list[NodeId]:
+        return [node for node in self._IncrementalMeritRank__graph.nodes() if node.startswith("U")]
+
+    def get_ego_global_edges(self, ego) -> list[tuple[NodeId, float]]:
+        # The edges of the ego in the reduced graph of the global ranking
+        return [(dest, score) for dest, score in self.get_ranks(ego).items()
                 if ((dest.startswith("U") or dest.startswith("B"))
-                        and (score > 0.0)
-                        and (ego != dest)):
-                    reduced_graph.add_edge(ego, dest, weight=score)
+                    and (score > 0.0)
+                    and (ego != dest))]
 
-        top_nodes = nx.pagerank(reduced_graph)
+    @staticmethod
+    def rank_global_beacons(reduced_graph) -> list[tuple[NodeId, float]]:
+        with stage("global_ranking.pagerank"):
+            top_nodes = nx.pagerank(reduced_graph)
         sorted_ranks = sorted(((k, v) for k, v in top_nodes.items() if k.startswith('B')), key=lambda x: x[1],
                               reverse=True)
         return sorted_ranks
 
-    def refresh_zero_opinion(self, zero_node, top_nodes_limit=100):
+    @profiled("global_ranking")
+    def get_top_beacons_global(self):
+        reduced_graph = nx.DiGraph()
+        for ego in self.get_user_nodes():
+            check_deadline()
+            reduced_graph.add_weighted_edges_from(
+                (ego, dest, score) for dest, score in self.get_ego_global_edges(ego))
+        return self.rank_global_beacons(reduced_graph)
+
+    def update_global_ranking(self, ranks) -> GlobalRanking:
+        old_ranking = self.global_ranking
+        if old_ranking is None or old_ranking.ranks != ranks:
+            self.global_ranking = GlobalRanking(
+                version=old_ranking.version + 1 if old_ranking else 1,
+                updated_at=time.time(),
+                ranks=ranks)
+        return self.global_ranking
+
+    def refresh_global_ranking(self) -> GlobalRanking:
+        return self.update_global_ranking(self.get_top_beacons_global())
+
+    def replace_node_edges(self, node, edges: list[tuple[NodeId, float]]) -> list[tuple[NodeId, float]]:
+        """
+        Set the weights of the given outgoing edges of the node, zeroing out the rest.
+        Returns the previous edges.
+        """
+        old_edges = []
+        if self._IncrementalMeritRank__graph.has_node(node):
+            old_edges = [(dst, weight) for _, dst, weight in self.get_node_edges(node)]
+        new_dsts = {dst for dst, _ in edges}
+        for dst, _ in old_edges:
+            if dst not in new_dsts:
+                self.add_edge(node, dst, 0.0)
+        for dst, weight in edges:
+            self.add_edge(node, dst, weight)
+        return old_edges
+
+    async def __replace_node_edges(self, single_flight, node, edges):
+        # Changing the edges is quick, so it is done even after the deadline,
+        # not to leave the zero node without its opinion
+        token = current_deadline.set(None)
+        try:
+            return await single_flight.run(self.replace_node_edges, node, edges)
+        finally:
+            current_deadline.reset(token)
+
+    async def refresh_zero_opinion(self, single_flight, zero_node, top_nodes_limit=100):
+        """
+        Recalculate the global ranking, and set the opinion of the zero node to its top nodes.
+        The ranks of the egos are collected one ego at a time, and the ranking itself
+        is calculated without holding the rank lock, so the requests are served in between.
+        """
         # Zero out existing edges of the zero node, to avoid affecting
         # the global ranking calculation
-        for _, dst, _ in self.get_node_edges(zero_node):
-            self.add_edge(zero_node, dst, 0.0)
-        top_nodes = self.get_top_beacons_global()
-        for dst, score in top_nodes[:top_nodes_limit]:
-            self.add_edge(zero_node, dst, score)
+        old_edges = await self.__replace_node_edges(single_flight, zero_node, [])
+        try:
+            reduced_graph = nx.DiGraph()
+            for ego in await single_flight.run(self.get_user_nodes):
+                check_deadline()
+                edges = await single_flight.run(self.get_ego_global_edges, ego)
+                reduced_graph.add_weighted_edges_from((ego, dest, score) for dest, score in edges)
+            ranks = await asyncio.to_thread(self.rank_global_beacons, reduced_graph)
+        except (Exception, asyncio.CancelledError):
+            # Restore the previous opinion, e.g. if the calculation was aborted after the deadline
+            await self.__replace_node_edges(single_flight, zero_node, old_edges)
+            raise
+        await self.__replace_node_edges(single_flight, zero_node, ranks[:top_nodes_limit])
+        self.update_global_ranking(ranks)
 
+    @profiled("gravity_graph.path")
     def add_path_to_graph(self, G, ego, focus):
         if ego == focus:
             return
@@ -81,16 +228,30 @@ class GravityRank(LazyMeritRank):
             edges.append(final_edge)
         G.add_weighted_edges_from(edges)
 
-    def get_users_stats(self, ego) -> dict[str, (float, float)]:
-        all_ranks = self.get_ranks(ego)
+    def get_positive_users(self, ego) -> dict[str, float]:
+        return {node: score for node, score in self.get_ranks(ego).items()
+                if node.startswith("U") and score > 0.0}
+
+    @profiled("users_stats")
+    def get_users_stats(self, ego, reverse_scores: dict[str, float] = None,
+                        positive_users: dict[str, float] = None) -> dict[str, (float, float)]:
+        # The reverse scores can be passed by the caller, e.g. in cluster mode those are
+        # calculated by the other shards. Then the users without a reverse score are skipped.
+        if positive_users is None:
+            positive_users = self.get_positive_users(ego)
         users_stats = {}
-        for node, score in all_ranks.items():
-            if node.startswith("U") and score > 0.0:
-                # Get both forward (ego->node), and reverse (node->ego) scores
-                users_stats[node] = score, self.get_node_score(node, ego)
+        for node, score in positive_users.items():
+            check_deadline()
+            # Get both forward (ego->node), and reverse (node->ego) scores
+            if reverse_scores is None:
+                reverse_score = self.get_node_score(node, ego)
+            elif (reverse_score := reverse_scores.get(node)) is None:
+                continue
+            users_stats[node] = score, reverse_score
 
         return users_stats
 
+    @profiled("gravity_graph.limit")
     def remove_outgoing_edges_upto_limit(self, G, ego, focus, limit):
         neighbours = list(dest for src, dest in G.out_edges(focus))
 
@@ -112,12 +273,14 @@ class GravityRank(LazyMeritRank):
         # where comments can't have outgoing negative edges.
         return w_ab * w_bc * (-1 if w_ab < 0 and w_bc < 0 else 1)
 
+    @profiled("gravity_graph")
     def gravity_graph(self, ego: str, focus: str,
                       positive_only: bool = True,
                       limit: int | None = None
                       ) -> tuple[list[Edge], dict[str, float]]:
         G = nx.DiGraph()
         for a, b, _ in self.get_node_edges(focus):
+            check_deadline()
             if b.startswith("U"):
                 if positive_only and self.get_node_score(ego, b) <= 0:
                     continue
@@ -154,19 +317,25 @@ class GravityRank(LazyMeritRank):
 
         return edges, nodes_dict
 
-    async def zero_opinion_heartbeat(self, zero_node, top_nodes_limit, refresh_period):
+    async def zero_opinion_heartbeat(self, single_flight, zero_node, top_nodes_limit, refresh_period):
         self.logger.info(f"Starting zero opinion heartbeat")
         while True:
             self.logger.info(f"Refreshing zero opinion")
-            self.refresh_zero_opinion(zero_node=zero_node, top_nodes_limit=top_nodes_limit)
+            try:
+                await single_flight.do(("refresh_zero_opinion", zero_node, top_nodes_limit),
+                                       self.refresh_zero_opinion, single_flight, zero_node, top_nodes_limit)
+            except AdmissionError as e:
+                # E.g. aborted after the deadline, or a refresh from PUT /zero is already queued
+                self.logger.warning(f"Skipped zero opinion refresh: {e}")
+            except Exception as e:
+                self.logger.error(f"Zero opinion refresh failed: {repr(e)}", exc_info=e)
             await asyncio.sleep(refresh_period)
 
-    async def warmup(self, wait_time=0):
+    async def warmup(self, single_flight, wait_time=0):
         # Maybe wait a bit for other services to start up
         await asyncio.sleep(wait_time)
         self.logger.info(f"Starting ego warmup")
-        all_egos = [ego for ego in self._IncrementalMeritRank__graph.nodes() if ego.startswith("U")]
+        all_egos = [ego for ego in await single_flight.run(self.get_user_nodes) if self.owns_ego(ego)]
         for ego in all_egos:
-            self.calculate(ego)
-            # Just pass the control to the reactor for a brief moment
-            await asyncio.sleep(0.01)
+            # Calculate one ego at a time, letting the requests take the rank lock in between
+            await single_flight.run(self.calculate, ego)
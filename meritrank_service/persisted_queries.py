@@ -0,0 +1,107 @@
+import hashlib
+import json
+from collections import OrderedDict
+
+from graphql import GraphQLError
+from strawberry.fastapi import GraphQLRouter
+from strawberry.http import GraphQLRequestData
+from strawberry.http.exceptions import HTTPException
+from strawberry.types import ExecutionResult
+
+from meritrank_service.log import LOGGER
+
+LOGGER = LOGGER.getChild("persisted_queries")
+
+
+class PersistedQueryError(Exception):
+    def __init__(self, message, code):
+        super().__init__(message)
+        self.code = code
+
+
+def get_persisted_query_hash(data: dict) -> str | None:
+    """
+    Returns the persisted query hash from the extensions of the GraphQL request data, if any.
+    """
+    extensions = data.get("extensions")
+    if isinstance(extensions, str):
+        # Query parameters of GET requests are not decoded
+        try:
+            extensions = json.loads(extensions)
+        except json.JSONDecodeError:
+            return None
+    if isinstance(extensions, dict) and isinstance(persisted_query := extensions.get("persistedQuery"), dict):
+        return persisted_query.get("sha256Hash")
+    return None
+
+
+class PersistedQueries:
+    """
+    LRU store of the persisted queries by their SHA-256 hashes.
+    """
+
+    def __init__(self, limit: int = 1000) -> None:
+        self.__limit = limit
+        self.__queries: OrderedDict[str, str] = OrderedDict()
+
+    def resolve(self, query: str | None, sha256_hash: str) -> str:
+        """
+        Returns the query persisted by the hash if no query is given,
+        otherwise checks the hash of the given query and persists it.
+        """
+        if query is None:
+            if (query := self.__queries.get(sha256_hash)) is None:
+                raise PersistedQueryError("PersistedQueryNotFound", "PERSISTED_QUERY_NOT_FOUND")
+            self.__queries.move_to_end(sha256_hash)
+            return query
+
+        if hashlib.sha256(query.encode()).hexdigest() != sha256_hash:
+            raise PersistedQueryError("provided sha does not match query", "INVALID_PERSISTED_QUERY_HASH")
+        LOGGER.debug("Registering persisted query %s", sha256_hash)
+        self.__queries[sha256_hash] = query
+        self.__queries.move_to_end(sha256_hash)
+        if len(self.__queries) > self.__limit:
+            self.__queries.popitem(last=False)
+        return query
+
+
+class PersistedQueriesRouter(GraphQLRouter):
+    """
+    GraphQL router supporting Automatic Persisted Queries (the Apollo protocol).
+    The client sends just the SHA-256 hash of the query in
+    `extensions.persistedQuery.sha256Hash`. If the hash is unknown, the client
+    gets the `PersistedQueryNotFound` error, and then resends the request with both
+    the query and the hash, so the query is registered for the later requests.
+    """
+
+    def __init__(self, *args, persisted_queries_limit: int = 1000, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.__persisted_queries = PersistedQueries(persisted_queries_limit)
+
+    def should_render_graphiql(self, request) -> bool:
+        # Persisted query GET requests come without the query, just like GraphiQL ones
+        return "extensions" not in request.query_params and super().should_render_graphiql(request)
+
+    async def parse_http_body(self, request) -> GraphQLRequestData:
+        # The same as in the base view, but the decoded body is also used to get the extensions
+        content_type = request.content_type or ""
+        if "application/json" in content_type:
+            data = self.parse_json(await request.get_body())
+        elif content_type.startswith("multipart/form-data"):
+            data = await self.parse_multipart(request)
+        elif request.method == "GET":
+            data = self.parse_query_params(request.query_params)
+        else:
+            raise HTTPException(400, "Unsupported content type")
+
+        query = data.get("query")
+        if (sha256_hash := get_persisted_query_hash(data)) is not None:
+            query = self.__persisted_queries.resolve(query, sha256_hash)
+        return GraphQLRequestData(query=query, variables=data.get("variables"),
+                                  operation_name=data.get("operationName"))
+
+    async def execute_operation(self, request, context, root_value) -> ExecutionResult:
+        try:
+            return await super().execute_operation(request, context, root_value)
+        except PersistedQueryError as e:
+            return ExecutionResult(data=None, errors=[GraphQLError(str(e), extensions={"code": e.code})])
@@ -13,7 +13,7 @@ def create_notification_listener(postgres_url, channel_name, callback):
             return
         e = Edge.parse_raw(notification.payload)
         LOGGER.debug("Received notification from Postgres: %s", notification.payload)
-        callback(e.src, e.dest, e.weight)
+        await callback(e.src, e.dest, e.weight)
 
     return listener.run(
         {channel_name: handle_notifications},
@@ -0,0 +1,184 @@
+import asyncio
+import csv
+import io
+
+import psycopg2
+from meritrank_python.rank import NodeDoesNotExist, EgoNotInitialized, EgoCounterEmpty
+
+from meritrank_service.gravity_rank import GravityRank
+from meritrank_service.log import LOGGER
+from meritrank_service.single_flight import SingleFlight
+
+LOGGER = LOGGER.getChild("scores_exporter")
+
+EGO_SCORES_TABLE = "meritrank_ego_scores"
+GLOBAL_BEACONS_TABLE = "meritrank_global_beacons"
+USERS_STATS_TABLE = "meritrank_users_stats"
+
+CREATE_TABLES_SQL = f"""
+CREATE TABLE IF NOT EXISTS {EGO_SCORES_TABLE} (
+    ego TEXT NOT NULL,
+    node TEXT NOT NULL,
+    score DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (ego, node)
+);
+CREATE TABLE IF NOT EXISTS {GLOBAL_BEACONS_TABLE} (
+    position INTEGER NOT NULL PRIMARY KEY,
+    node TEXT NOT NULL,
+    score DOUBLE PRECISION NOT NULL
+);
+CREATE TABLE IF NOT EXISTS {USERS_STATS_TABLE} (
+    ego TEXT NOT NULL,
+    node TEXT NOT NULL,
+    node_score DOUBLE PRECISION NOT NULL,
+    ego_score DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (ego, node)
+);
+"""
+
+
+def rows_to_csv(rows) -> io.StringIO:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    return buffer
+
+
+def copy_rows(cursor, table, columns, rows):
+    cursor.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        rows_to_csv(rows))
+
+
+class PostgresScoresExporter:
+    """
+    Periodically writes the scores calculated by the service into Postgres,
+    so other services can query those directly instead of polling the API.
+    Only the egos affected by edge changes since the last export
+    (and the newly calculated ones) are re-exported. The exporter never calculates
+    new egos, so the users stats only include the users that are egos already.
+    """
+
+    def __init__(self, rank: GravityRank, single_flight: SingleFlight, postgres_url,
+                 top_nodes_limit: int = 100,
+                 batch_size: int = 50,
+                 batch_pause: float = 0.1) -> None:
+        self.__rank = rank
+        self.__single_flight = single_flight
+        self.__postgres_url = postgres_url
+        self.__top_nodes_limit = top_nodes_limit
+        self.__batch_size = batch_size
+        self.__batch_pause = batch_pause
+        self.__changed_egos = set()
+        self.__exported_egos = set()
+        self.__tables_created = False
+        self.__exported_global_version = None
+        rank.add_edge_listener(self.__on_edge_changed)
+
+    def __on_edge_changed(self, src, dest, weight, affected_egos):
+        self.__changed_egos.update(affected_egos)
+
+    def pop_changed_egos(self) -> set:
+        # The egos dropped by replacing the graph are exported again once those are recalculated
+        self.__exported_egos &= self.__rank.egos
+        changed_egos = self.__changed_egos | (self.__rank.egos - self.__exported_egos)
+        self.__changed_egos = set()
+        return changed_egos
+
+    def __execute_in_transaction(self, fun, *args):
+        connection = psycopg2.connect(self.__postgres_url)
+        try:
+            # Psycopg2 connection context commits the transaction on success
+            # and rolls it back on exception, but does not close the connection.
+            with connection, connection.cursor() as cursor:
+                if not self.__tables_created:
+                    cursor.execute(CREATE_TABLES_SQL)
+                fun(cursor, *args)
+            self.__tables_created = True
+        finally:
+            connection.close()
+
+    @staticmethod
+    def __replace_egos_rows(cursor, egos, scores_rows, stats_rows):
+        cursor.execute(f"DELETE FROM {EGO_SCORES_TABLE} WHERE ego = ANY(%s)", (egos,))
+        cursor.execute(f"DELETE FROM {USERS_STATS_TABLE} WHERE ego = ANY(%s)", (egos,))
+        copy_rows(cursor, EGO_SCORES_TABLE, ("ego", "node", "score"), scores_rows)
+        copy_rows(cursor, USERS_STATS_TABLE, ("ego", "node", "node_score", "ego_score"), stats_rows)
+
+    @staticmethod
+    def __replace_global_rows(cursor, beacons_rows):
+        cursor.execute(f"DELETE FROM {GLOBAL_BEACONS_TABLE}")
+        copy_rows(cursor, GLOBAL_BEACONS_TABLE, ("position", "node", "score"), beacons_rows)
+
+    def __collect_ego_rows(self, ego, scores_rows, stats_rows):
+        # Only the egos already calculated for the live requests are exported,
+        # as calculating the walks of new egos here would eventually calculate the whole graph
+        egos = self.__rank.egos
+        if ego not in egos:
+            return
+        try:
+            for node, score in self.__rank.get_ranks(ego, limit=self.__top_nodes_limit).items():
+                scores_rows.append((ego, node, score))
+            positive_users = self.__rank.get_positive_users(ego)
+            reverse_scores = {node: self.__rank.get_node_score(node, ego) for node in positive_users if node in egos}
+            for node, (node_score, ego_score) in self.__rank.get_users_stats(
+                    ego, reverse_scores, positive_users).items():
+                stats_rows.append((ego, node, node_score, ego_score))
+        except (NodeDoesNotExist, EgoNotInitialized, EgoCounterEmpty) as e:
+            LOGGER.warning("Skipping export of ego %s: %s", ego, repr(e))
+
+    async def collect_egos_rows(self, egos):
+        scores_rows, stats_rows = [], []
+        for ego in egos:
+            # Take the rank lock for one ego at a time, so live requests are not held up for long
+            await self.__single_flight.run(self.__collect_ego_rows, ego, scores_rows, stats_rows)
+        return scores_rows, stats_rows
+
+    async def export_global_ranking(self):
+        # The global ranking is calculated by the zero heartbeat (or PUT /zero),
+        # and is only rewritten if its version changed since the last export
+        ranking = self.__rank.global_ranking
+        if ranking is None or ranking.version == self.__exported_global_version:
+            return
+        LOGGER.info("Exporting global ranking version %i", ranking.version)
+        beacons_rows = [(position, node, score) for position, (node, score) in enumerate(ranking.ranks)]
+        try:
+            await asyncio.to_thread(self.__execute_in_transaction,
+                                    self.__replace_global_rows, beacons_rows)
+            self.__exported_global_version = ranking.version
+        except (Exception, psycopg2.Error) as error:
+            LOGGER.error(f"Error while exporting global ranking to PostgreSQL {error}")
+
+    async def export_changed_egos(self):
+        # The edge listener is called in the worker threads, so pop the egos under the rank lock
+        egos = sorted(await self.__single_flight.run(self.pop_changed_egos))
+        if not egos:
+            LOGGER.debug("No changed egos, skipping egos export")
+            return
+        LOGGER.info("Exporting scores for %i egos", len(egos))
+        for i in range(0, len(egos), self.__batch_size):
+            batch = egos[i:i + self.__batch_size]
+            scores_rows, stats_rows = await self.collect_egos_rows(batch)
+            try:
+                await asyncio.to_thread(self.__execute_in_transaction,
+                                        self.__replace_egos_rows, batch, scores_rows, stats_rows)
+            except (Exception, psycopg2.Error) as error:
+                LOGGER.error(f"Error while exporting scores to PostgreSQL {error}")
+                # Retry the rest of the egos during the next export
+                self.__changed_egos.update(egos[i:])
+                return
+            self.__exported_egos.update(batch)
+            await asyncio.sleep(self.__batch_pause)
+
+    async def export(self):
+        # The global ranking changes independently of the edges (e.g. by the zero heartbeat),
+        # so it is checked on every export, even if no egos changed
+        await self.export_global_ranking()
+        await self.export_changed_egos()
+        LOGGER.info("Finished scores export")
+
+    async def run(self, period):
+        LOGGER.info("Starting scores export")
+        while True:
+            await self.export()
+            await asyncio.sleep(period)
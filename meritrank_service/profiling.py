@@ -0,0 +1,290 @@
+import asyncio
+import cProfile
+import marshal
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from functools import wraps
+
+from strawberry.extensions import SchemaExtension
+
+from meritrank_service.log import LOGGER
+
+LOGGER = LOGGER.getChild("profiling")
+
+# Requests with this header set (to any value) are profiled even when profiling is disabled
+PROFILE_HEADER = b"x-meritrank-profile"
+
+current_profile: ContextVar["RequestProfile | None"] = ContextVar("current_profile", default=None)
+
+# Reused for every stage of the requests that are not profiled, to keep the overhead near zero
+NULL_STAGE = nullcontext()
+
+
+class RequestProfile:
+    def __init__(self, method: str, path: str) -> None:
+        self.method = method
+        self.path = path
+        self.started_at = time.time()
+        self.total = None
+        # Stage name -> [total seconds, number of times the stage was entered]
+        self.stages: dict[str, list[float | int]] = {}
+
+    def add(self, name: str, duration: float):
+        s = self.stages.setdefault(name, [0.0, 0])
+        s[0] += duration
+        s[1] += 1
+
+    def server_timing(self) -> str:
+        timings = [f"{name};dur={seconds * 1000:.3f}" for name, (seconds, _) in self.stages.items()]
+        if self.total is not None:
+            timings.append(f"total;dur={self.total * 1000:.3f}")
+        return ", ".join(timings)
+
+    def as_dict(self) -> dict:
+        return {
+            "method": self.method,
+            "path": self.path,
+            "started_at": self.started_at,
+            "total": self.total,
+            "stages": {name: {"seconds": seconds, "count": count} for name, (seconds, count) in self.stages.items()}
+        }
+
+
+class Stage:
+    __slots__ = ("profile", "name", "start")
+
+    def __init__(self, profile: RequestProfile, name: str) -> None:
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *_):
+        self.profile.add(self.name, time.perf_counter() - self.start)
+
+
+def stage(name: str):
+    """
+    Time the enclosed block as the given stage of the profiled request.
+    Stages may be nested, e.g. "walks" are often generated inside "users_stats".
+    """
+    if (profile := current_profile.get()) is None:
+        return NULL_STAGE
+    return Stage(profile, name)
+
+
+def profiled(name: str):
+    """
+    Decorator timing every call of the function as the given stage of the profiled request.
+    """
+    def decorator(fun):
+        @wraps(fun)
+        def wrapper(*args, **kwargs):
+            if (profile := current_profile.get()) is None:
+                return fun(*args, **kwargs)
+            with Stage(profile, name):
+                return fun(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def profiled_iterator(name: str, iterator):
+    """
+    Time producing each item of the iterator as the given stage of the profiled request.
+    Iterators of streaming responses are consumed outside the request's context,
+    so the profile is taken when this is called. The time spent while sending the response body
+    is not in the Server-Timing header, only in the recent profiles.
+    """
+    if (profile := current_profile.get()) is None:
+        return iterator
+
+    def timed():
+        items = iter(iterator)
+        while True:
+            with Stage(profile, name):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            yield item
+
+    return timed()
+
+
+class ProfilingExtension(SchemaExtension):
+    def on_parse(self):
+        with stage("graphql.parse"):
+            yield
+
+    def on_validate(self):
+        with stage("graphql.validate"):
+            yield
+
+    def on_execute(self):
+        with stage("graphql.execute"):
+            yield
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_stacks(duration: float, interval: float) -> Counter:
+    """
+    Periodically sample the stacks of all the threads (except the calling one),
+    counting identical stacks. The root of each stack is the name of its thread.
+    """
+    stacks = Counter()
+    sampler_id = threading.get_ident()
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == sampler_id:
+                continue
+            names = []
+            while frame is not None:
+                names.append(frame_name(frame))
+                frame = frame.f_back
+            names.append(thread_names.get(thread_id, f"thread-{thread_id}"))
+            stacks[";".join(reversed(names))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+class ThreadProfiles:
+    """
+    The cProfile profiles recorded by the worker threads during a capture.
+    cProfile only records the thread that enabled it, so the computations
+    in the worker threads record their own profiles, merged after the capture.
+    """
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.profiles: list[cProfile.Profile] = []
+
+    @contextmanager
+    def record(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self.__lock:
+                self.profiles.append(profile)
+
+
+# Set while a cProfile capture is running
+active_thread_profiles: ThreadProfiles | None = None
+
+
+def profiled_thread():
+    """
+    Record the enclosed block of a worker thread into the running cProfile capture, if any.
+    """
+    if (thread_profiles := active_thread_profiles) is None:
+        return NULL_STAGE
+    return thread_profiles.record()
+
+
+class Profiler:
+    """
+    Opt-in profiling of the service. Requests are profiled either when
+    the profiling is enabled (for a sample of all the requests), or when
+    the request has the profiling header. The timings of the stages are returned
+    in the Server-Timing response header, and the recent profiles are kept for download.
+
+    Additionally, a whole-process profile can be captured for a time window,
+    either with cProfile (pstats format) or by sampling the stacks of all the threads
+    (collapsed stacks format, as used by flamegraph.pl and speedscope).
+    """
+
+    def __init__(self, history_size: int = 100) -> None:
+        self.enabled = False
+        self.sample_rate = 1.0
+        self.recent_profiles = deque(maxlen=history_size)
+        self.capture_task: asyncio.Task | None = None
+        self.capture_mode: str | None = None
+        self.capture_result: bytes | None = None
+
+    def should_profile(self, headers) -> bool:
+        if any(name == PROFILE_HEADER for name, _ in headers):
+            return True
+        return self.enabled and random.random() < self.sample_rate
+
+    async def __capture(self, mode: str, duration: float, interval: float) -> bytes:
+        global active_thread_profiles
+        if mode == "cprofile":
+            thread_profiles = active_thread_profiles = ThreadProfiles()
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                await asyncio.sleep(duration)
+            finally:
+                profile.disable()
+                active_thread_profiles = None
+            stats = pstats.Stats(profile)
+            # The computations still running in the worker threads are not included
+            for thread_profile in thread_profiles.profiles:
+                stats.add(thread_profile)
+            # The same format as written by pstats.Stats.dump_stats
+            return marshal.dumps(stats.stats)
+        stacks = await asyncio.to_thread(sample_stacks, duration, interval)
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.items()).encode()
+
+    def start_capture(self, mode: str, duration: float, interval: float = 0.005) -> bool:
+        if self.capture_task is not None and not self.capture_task.done():
+            return False
+        LOGGER.info("Starting %s profile capture for %f seconds", mode, duration)
+        self.capture_mode = mode
+        self.capture_result = None
+
+        async def capture():
+            self.capture_result = await self.__capture(mode, duration, interval)
+            LOGGER.info("Finished %s profile capture", mode)
+
+        self.capture_task = asyncio.create_task(capture())
+        return True
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware setting up the profile for the profiled requests.
+    """
+
+    def __init__(self, app, profiler: Profiler) -> None:
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.profiler.should_profile(scope["headers"]):
+            return await self.app(scope, receive, send)
+
+        profile = RequestProfile(scope["method"], scope["path"])
+        token = current_profile.set(profile)
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                profile.total = time.perf_counter() - start
+                message["headers"] = [*message.get("headers", []),
+                                      (b"server-timing", profile.server_timing().encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_profile.reset(token)
+            # Include the time to send the response body
+            profile.total = time.perf_counter() - start
+            self.profiler.recent_profiles.append(profile)
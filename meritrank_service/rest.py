@@ -1,10 +1,21 @@
-from classy_fastapi import Routable, get, put
+import asyncio
+import contextvars
+from datetime import datetime, timezone
+from typing import Literal
+
+from classy_fastapi import Routable, get, post, put
+from fastapi import Header, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 from meritrank_python.rank import NodeId
-from meritrank_python.lazy import LazyMeritRank
 
+from meritrank_service.admission import check_deadline
+from meritrank_service.gravity_rank import GravityRank
 from meritrank_service.log import LOGGER as TOPLEVEL_LOGGER
+from meritrank_service.profiling import Profiler, profiled_iterator
+from meritrank_service.score_encoding import negotiate_media_type, encode_scores, supported_media_types
+from meritrank_service.single_flight import SingleFlight
 
 
 class Edge(BaseModel):
@@ -19,13 +30,47 @@ class NodeScore(BaseModel):
     score: float
 
 
+class GlobalRank(BaseModel):
+    node: NodeId
+    score: float
+
+
+class GlobalRankingPage(BaseModel):
+    version: int
+    updated_at: datetime
+    total: int
+    offset: int
+    ranks: list[GlobalRank]
+
+
 LOGGER = TOPLEVEL_LOGGER.getChild("REST")
 
 
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    # If-None-Match uses the weak comparison, so "W/" prefixes are ignored
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag.removeprefix("W/") in tags
+
+
+def log_task_exception(task: asyncio.Task):
+    if not task.cancelled() and (e := task.exception()) is not None:
+        LOGGER.error("Background task failed: %s", repr(e), exc_info=e)
+
+
 class MeritRankRestRoutes(Routable):
-    def __init__(self, rank: LazyMeritRank) -> None:
+    def __init__(self, rank: GravityRank, single_flight: SingleFlight = None,
+                 max_walk_count: int | None = None, profiler: Profiler = None) -> None:
         super().__init__()
         self.__rank = rank
+        self.__single_flight = single_flight or SingleFlight()
+        self.__max_walk_count = max_walk_count
+        self.__profiler = profiler or Profiler()
+        # Keep references to background tasks, so those are not garbage-collected
+        self.__background_tasks = set()
         LOGGER.info("Created REST router")
 
     @get("/healthcheck")
@@ -40,9 +85,26 @@ class MeritRankRestRoutes(Routable):
         :param ego: the node to create ego for
         :param count: the number of walks to generate for the ego
         """
-        self.__rank.calculate(ego, num_walks=count)
+        if self.__max_walk_count is not None and count > self.__max_walk_count:
+            raise HTTPException(422, f"Walk count must not exceed {self.__max_walk_count}")
+        await self.__single_flight.do(("calculate", ego, count), self.__rank.calculate, ego, num_walks=count)
         return {"message": f"Calculated {count} walks for {ego}"}
 
+    @get("/metrics")
+    async def metrics(self):
+        """
+        Get the service's internal counters.
+        "single_flight" lists, for each operation, the number of actually
+        performed computations and the number of requests that were served
+        by joining an identical in-flight computation.
+        "admission" lists, for each limited operation, the numbers of admitted,
+        waiting, rejected and timed out requests.
+        """
+        metrics = {"single_flight": self.__single_flight.stats()}
+        if (admission := self.__single_flight.admission) is not None:
+            metrics["admission"] = admission.stats()
+        return metrics
+
     @get("/calculate")
     async def get_calculate_count(self, ego: NodeId):
         """
@@ -51,19 +113,56 @@ class MeritRankRestRoutes(Routable):
         """
         return {"count": self.__rank.walk_count_for_ego(ego)}
 
-    @put("/zero")
+    @put("/zero", status_code=202)
     async def put_zero(self, zero_node: NodeId, top_nodes_limit: int = 100):
         """
         (Re)Intialize a "Zero" node with the given node id.
-        Putting this node will initiate calculating the global ranking
-        and then add outgoing edges from it to the *count* top nodes.
+        Putting this node will schedule calculating the global ranking
+        and then adding outgoing edges from it to the *count* top nodes.
+        The request returns immediately, without waiting for the calculation.
+        The ranks of the egos are collected one ego at a time,
+        so the other requests are served in between.
 
         :param zero_node: the node id to initialize
         :param top_nodes_limit: the number of top nodes to add
         """
-        self.__rank.refresh_zero_opinion(zero_node, top_nodes_limit)
+        # Run the task in a fresh context, so it is not accounted to this request's profile
+        task = asyncio.create_task(self.__single_flight.do(
+            ("refresh_zero_opinion", zero_node, top_nodes_limit),
+            self.__rank.refresh_zero_opinion, self.__single_flight, zero_node, top_nodes_limit),
+            context=contextvars.Context())
+        self.__background_tasks.add(task)
+        task.add_done_callback(self.__background_tasks.discard)
+        task.add_done_callback(log_task_exception)
         return {"message": f"Initiated zero {zero_node}"}
 
+    @get("/global_ranking", response_model=GlobalRankingPage, responses={304: {}, 404: {}})
+    async def get_global_ranking(self, response: Response,
+                                 offset: int = Query(default=0, ge=0),
+                                 limit: int = Query(default=100, ge=1),
+                                 if_none_match: str | None = Header(default=None)):
+        """
+        Get a page of the latest global beacons ranking, as calculated by
+        the zero heartbeat (or PUT /zero). The ranking is versioned:
+        the version is returned as the ETag header, and the requests with a matching
+        If-None-Match header are answered with 304 Not Modified.
+
+        :param offset: the position of the first rank to return
+        :param limit: the maximum number of ranks to return
+        """
+        if (ranking := self.__rank.global_ranking) is None:
+            return Response(status_code=404, content="Global ranking was not calculated yet")
+        etag = f'W/"{ranking.version}"'
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        response.headers["ETag"] = etag
+        return GlobalRankingPage(
+            version=ranking.version,
+            updated_at=datetime.fromtimestamp(ranking.updated_at, tz=timezone.utc),
+            total=len(ranking.ranks),
+            offset=offset,
+            ranks=[GlobalRank(node=node, score=score) for node, score in ranking.ranks[offset:offset + limit]])
+
     @put("/loglevel")
     async def loglevel(self, loglevel: str):
         """
@@ -74,6 +173,56 @@ class MeritRankRestRoutes(Routable):
         LOGGER.info("Changed log level to %s", loglevel)
         return {"message": f"Set log level to {loglevel}"}
 
+    @put("/profiling")
+    async def put_profiling(self, enabled: bool, sample_rate: float = Query(default=1.0, gt=0.0, le=1.0)):
+        """
+        Enable or disable profiling of the requests. When enabled, the given share
+        of the requests is profiled. Regardless of this setting, the requests with
+        the X-MeritRank-Profile header are always profiled.
+        The stage timings are returned in the Server-Timing response header.
+        :param enabled: whether to profile the requests
+        :param sample_rate: the share of the requests to profile
+        """
+        self.__profiler.enabled = enabled
+        self.__profiler.sample_rate = sample_rate
+        LOGGER.info("Set profiling enabled=%s, sample rate %f", enabled, sample_rate)
+        return {"message": f"Set profiling enabled={enabled} with sample rate {sample_rate}"}
+
+    @get("/profiling/requests")
+    async def get_profiled_requests(self):
+        """
+        Get the stage timings of the recently profiled requests.
+        """
+        return [profile.as_dict() for profile in self.__profiler.recent_profiles]
+
+    @put("/profiling/capture", status_code=202, responses={409: {}})
+    async def put_profiling_capture(self, duration: float = Query(default=10.0, gt=0.0, le=600.0),
+                                    mode: Literal["sample", "cprofile"] = "sample"):
+        """
+        Start capturing the profile of the whole service for the given time window.
+        The result is available from GET /profiling/capture after the window ends.
+        :param duration: the window length in seconds
+        :param mode: "sample" to periodically sample the stacks (collapsed stacks format for flame graphs),
+            or "cprofile" to record every call (pstats format, e.g. for snakeviz)
+        """
+        if not self.__profiler.start_capture(mode, duration):
+            raise HTTPException(409, "Profile capture is already running")
+        return {"message": f"Started {mode} profile capture for {duration} seconds"}
+
+    @get("/profiling/capture", responses={404: {}, 409: {}})
+    async def get_profiling_capture(self):
+        """
+        Download the result of the last profile capture.
+        """
+        profiler = self.__profiler
+        if profiler.capture_task is not None and not profiler.capture_task.done():
+            raise HTTPException(409, "Profile capture is still running")
+        if profiler.capture_result is None:
+            raise HTTPException(404, "No profile was captured")
+        filename = "meritrank.pstats" if profiler.capture_mode == "cprofile" else "meritrank.folded"
+        return Response(content=profiler.capture_result, media_type="application/octet-stream",
+                        headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
     @get("/edge/{src}/{dest}")
     async def get_edge(self, src: NodeId, dest: NodeId):
         if (weight := self.__rank.get_edge(src, dest)) is not None:
@@ -81,32 +230,68 @@ class MeritRankRestRoutes(Routable):
 
     @put("/edge")
     async def put_edge(self, edge: Edge):
-        self.__rank.add_edge(edge.src, edge.dest, edge.weight)
+        await self.__single_flight.run(self.__rank.add_edge, edge.src, edge.dest, edge.weight)
         LOGGER.info("Added edge: (%s, %s, %f)", edge.src, edge.dest, edge.weight)
         return {"message": f"Added edge {edge.src} -> {edge.dest} "
                            f"with weight {edge.weight}"}
 
     @put("/graph")
     async def put_graph(self, edges_list: list[Edge]):
-        # Replace the existing MeritRank instance with a new one,
-        # initialized from the given graph
+        # Replace the graph of the existing MeritRank instance,
+        # as it is shared with GraphQL and the background tasks
         graph = {}
         for edge in edges_list:
             graph.setdefault(edge.src, {}).setdefault(edge.dest, {})[
                 'weight'] = edge.weight
 
-        self.__rank = LazyMeritRank(graph)
+        await self.__single_flight.run(self.__rank.replace_graph, graph)
         return {"message": f"Added {len(edges_list)} edges"}
 
-    @get("/scores/{ego}")
-    async def get_scores(self, ego: NodeId, limit: int | None = None) -> list[NodeScore]:
-        return [NodeScore(node=node, ego=ego, score=score) for node, score in
-                self.__rank.get_ranks(ego, limit=limit).items()]
+    @get("/scores/{ego}", response_model=list[NodeScore], responses={
+        200: {"content": {media_type: {} for media_type in supported_media_types()}}, 406: {}})
+    async def get_scores(self, ego: NodeId, limit: int | None = None, accept: str | None = Header(default=None)):
+        """
+        Get the scores of the nodes from the perspective of the ego, sorted by score.
+        The response is streamed in chunks, in the format chosen by the Accept header:
+        "application/json" (default) for the list of node scores,
+        "application/x-ndjson" for a node score per line,
+        "application/vnd.meritrank.columnar+json" for the {"ego", "nodes", "scores"} object of lists,
+        "application/msgpack" for the same columnar object in MessagePack (if msgpack is installed).
+        :param ego: the node to get the scores for
+        :param limit: the maximum number of scores to return
+        """
+        if (media_type := negotiate_media_type(accept)) is None:
+            raise HTTPException(406, f"Supported media types are: {', '.join(supported_media_types())}")
+        ranks = await self.__single_flight.do(("ranks", ego, limit), self.__rank.get_ranks, ego, limit=limit)
+        # The encoding runs in a worker thread while the chunks are sent.
+        # The ranks are not modified after calculation, so sharing them is safe.
+        return StreamingResponse(profiled_iterator("rest.build", encode_scores(media_type, ego, ranks)),
+                                 media_type=media_type,
+                                 headers={"Vary": "Accept"})
 
     @get("/node_score/{ego}/{node}")
     async def get_node_score(self, ego: NodeId, node: NodeId) -> NodeScore:
-        return NodeScore(node=node, ego=ego, score=self.__rank.get_node_score(ego, node))
+        score = await self.__single_flight.do(("node_score", ego, node), self.__rank.get_node_score, ego, node)
+        return NodeScore(node=node, ego=ego, score=score)
+
+    @post("/node_scores/{node}")
+    async def get_node_scores(self, node: NodeId, egos: list[NodeId]) -> list[NodeScore]:
+        """
+        Get the scores of the node from the perspective of each of the given egos.
+        In cluster mode, used by the shards to get scores from the egos they don't own.
+        """
+        async def get_scores():
+            scores = []
+            for ego in egos:
+                # Take the rank lock for one ego at a time, as the walks of each ego may be calculated
+                check_deadline()
+                scores.append(await self.__single_flight.run(self.__rank.get_node_score, ego, node))
+            return scores
+
+        scores = await self.__single_flight.do(("node_scores", node, tuple(egos)), get_scores)
+        return [NodeScore(node=node, ego=ego, score=score) for ego, score in zip(egos, scores)]
 
     @get("/node_edges/{src}")
     async def get_node_edges(self, src: NodeId) -> list[Edge]:
-        return list(Edge(src=e[0], dest=e[1], weight=e[2]) for e in self.__rank.get_node_edges(src))
+        edges = await self.__single_flight.do(("node_edges", src), self.__rank.get_node_edges, src)
+        return list(Edge(src=e[0], dest=e[1], weight=e[2]) for e in edges)
@@ -0,0 +1,126 @@
+import json
+from itertools import islice
+from typing import Iterable, Iterator
+
+from meritrank_python.rank import NodeId
+
+try:
+    import msgpack
+except ImportError:
+    # msgpack is an optional dependency, the binary format is not offered without it
+    msgpack = None
+
+JSON = "application/json"
+NDJSON = "application/x-ndjson"
+COLUMNAR_JSON = "application/vnd.meritrank.columnar+json"
+MSGPACK = "application/msgpack"
+
+# Number of scores encoded at once, and sent as a single chunk of the response
+CHUNK_SIZE = 10000
+
+
+def supported_media_types() -> list[str]:
+    media_types = [JSON, NDJSON, COLUMNAR_JSON]
+    if msgpack is not None:
+        media_types.append(MSGPACK)
+    return media_types
+
+
+def negotiate_media_type(accept: str | None) -> str | None:
+    """
+    Pick the scores encoding for the Accept header, preferring the media types
+    with the higher quality, then the ones listed first.
+    Returns None if none of the accepted media types is supported.
+    """
+    if not accept:
+        return JSON
+    supported = supported_media_types()
+    candidates = []
+    for i, item in enumerate(accept.split(",")):
+        media_type, *params = (part.strip() for part in item.split(";"))
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality <= 0.0:
+            continue
+        media_type = media_type.lower()
+        if media_type in ("*/*", "application/*"):
+            media_type = JSON
+        elif media_type == "application/x-msgpack":
+            media_type = MSGPACK
+        if media_type in supported:
+            candidates.append((-quality, i, media_type))
+    return min(candidates)[2] if candidates else None
+
+
+def chunks(items: Iterable, size: int) -> Iterator[list]:
+    items = iter(items)
+    while chunk := list(islice(items, size)):
+        yield chunk
+
+
+def dumps(obj) -> str:
+    return json.dumps(obj, separators=(",", ":"))
+
+
+def encode_json(ego: NodeId, ranks: dict[NodeId, float], chunk_size: int) -> Iterator[bytes]:
+    # The same format as the list of NodeScore models, without building the models
+    yield b"["
+    separator = b""
+    for chunk in chunks(ranks.items(), chunk_size):
+        # Strip the brackets of the encoded list, to join the chunks into a single list
+        yield separator + dumps([{"node": n, "ego": ego, "score": s} for n, s in chunk])[1:-1].encode()
+        separator = b","
+    yield b"]"
+
+
+def encode_ndjson(ego: NodeId, ranks: dict[NodeId, float], chunk_size: int) -> Iterator[bytes]:
+    for chunk in chunks(ranks.items(), chunk_size):
+        yield "".join(dumps({"node": n, "ego": ego, "score": s}) + "\n" for n, s in chunk).encode()
+
+
+def encode_columnar_json(ego: NodeId, ranks: dict[NodeId, float], chunk_size: int) -> Iterator[bytes]:
+    yield f'{{"ego":{dumps(ego)},"nodes":['.encode()
+    separator = b""
+    for chunk in chunks(ranks.keys(), chunk_size):
+        yield separator + dumps(chunk)[1:-1].encode()
+        separator = b","
+    yield b'],"scores":['
+    separator = b""
+    for chunk in chunks(ranks.values(), chunk_size):
+        yield separator + dumps(chunk)[1:-1].encode()
+        separator = b","
+    yield b"]}"
+
+
+def encode_msgpack(ego: NodeId, ranks: dict[NodeId, float], chunk_size: int) -> Iterator[bytes]:
+    # The same columnar layout as the columnar JSON, written incrementally
+    packer = msgpack.Packer()
+    yield packer.pack_map_header(3) + packer.pack("ego") + packer.pack(ego) + packer.pack("nodes")
+    yield packer.pack_array_header(len(ranks))
+    for chunk in chunks(ranks.keys(), chunk_size):
+        yield b"".join(map(packer.pack, chunk))
+    yield packer.pack("scores") + packer.pack_array_header(len(ranks))
+    for chunk in chunks(ranks.values(), chunk_size):
+        yield b"".join(map(packer.pack, chunk))
+
+
+ENCODERS = {
+    JSON: encode_json,
+    NDJSON: encode_ndjson,
+    COLUMNAR_JSON: encode_columnar_json,
+    MSGPACK: encode_msgpack,
+}
+
+
+def encode_scores(media_type: str, ego: NodeId, ranks: dict[NodeId, float],
+                  chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Encode the scores of the ego in the given format, chunk by chunk.
+    """
+    return ENCODERS[media_type](ego, ranks, chunk_size)
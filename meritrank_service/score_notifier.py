@@ -0,0 +1,59 @@
+import asyncio
+from contextlib import contextmanager
+
+from meritrank_python.rank import NodeId
+
+from meritrank_service.gravity_rank import GravityRank
+from meritrank_service.log import LOGGER
+
+LOGGER = LOGGER.getChild("score_notifier")
+
+
+class ScoreChangeNotifier:
+    """
+    Notifies the subscribers of an ego when an edge change affects its walks.
+    Notifications are coalesced: a subscriber just gets its event set,
+    and is expected to wait for the debounce period before fetching the new scores.
+    """
+
+    def __init__(self, rank: GravityRank, debounce: float = 0.5) -> None:
+        self.debounce = debounce
+        # Ego -> set of (event loop, event) of the subscribers
+        self.__events: dict[NodeId, set[tuple[asyncio.AbstractEventLoop, asyncio.Event]]] = {}
+        rank.add_edge_listener(self.__on_edge_changed)
+
+    def __on_edge_changed(self, src, dest, weight, affected_egos):
+        # Edges are changed in the worker threads, so the events are set by their loops
+        for ego in affected_egos:
+            for loop, event in list(self.__events.get(ego, ())):
+                try:
+                    loop.call_soon_threadsafe(event.set)
+                except RuntimeError:
+                    # The loop is already closed
+                    pass
+
+    @contextmanager
+    def subscribe(self, ego: NodeId):
+        subscriber = asyncio.get_running_loop(), asyncio.Event()
+        self.__events.setdefault(ego, set()).add(subscriber)
+        LOGGER.debug("Subscribed to score changes for ego %s", ego)
+        try:
+            yield subscriber[1]
+        finally:
+            events = self.__events[ego]
+            events.discard(subscriber)
+            if not events:
+                del self.__events[ego]
+            LOGGER.debug("Unsubscribed from score changes for ego %s", ego)
+
+
+def diff_scores(sent: dict[NodeId, float], current: dict[NodeId, float],
+                threshold: float) -> tuple[dict[NodeId, float], list[NodeId]]:
+    """
+    Returns the scores that changed by at least the threshold since they were sent
+    (including the new ones), and the nodes that are no longer present.
+    """
+    changed = {node: score for node, score in current.items()
+               if node not in sent or abs(score - sent[node]) >= threshold}
+    removed = [node for node in sent if node not in current]
+    return changed, removed
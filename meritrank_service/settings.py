@@ -3,6 +3,8 @@ from typing import Optional
 
 from pydantic import BaseSettings, PostgresDsn, Field, validator, root_validator
 
+from meritrank_service.admission import OperationLimit, DEFAULT_OPERATION_LIMITS
+
 
 class MeritRankSettings(BaseSettings):
     pg_dsn: Optional[PostgresDsn] = Field(env="POSTGRES_DB_URL")
@@ -14,6 +16,19 @@ class MeritRankSettings(BaseSettings):
     zero_top_nodes_limit: int = 1000
     zero_heartbeat_period: int = 60*60  # Seconds to wait before refreshing zero's opinion on network
     walk_count = 10000 # number of random walks to perform for each ego
+    max_walk_count: int = 100000  # maximum number of walks that can be requested for an ego by PUT /calculate
+    # Limits for expensive operations, given as JSON, e.g.
+    # {"gravity_graph": {"max_concurrent": 2, "max_queue": 32, "timeout": 10.0}}
+    operation_limits: dict[str, OperationLimit] = DEFAULT_OPERATION_LIMITS
+    # Base URLs of all the shards in cluster mode, given as JSON list
+    cluster_shards: list[str] = []
+    cluster_shard: Optional[str] = None  # Base URL of this instance, one of the cluster shards
+    subscription_debounce: float = 0.5  # Seconds to collect edge changes before pushing score updates to subscribers
+    score_export: bool = False
+    score_export_period: int = 5*60  # Seconds to wait between exports of changed scores to Postgres
+    score_export_top_nodes_limit: int = 100  # Number of top scores to export for each ego
+    score_export_batch_size: int = 50  # Number of egos to export in a single transaction
+    score_export_batch_pause: float = 0.1  # Seconds to wait between export batches
 
     @validator('log_level')
     @classmethod
@@ -32,6 +47,12 @@ class MeritRankSettings(BaseSettings):
 
         return v.upper()  # return the validated and normalized log level
 
+    @validator('operation_limits')
+    @classmethod
+    def merge_operation_limits(cls, v):
+        # Operations missing from the given limits keep the default ones
+        return {**DEFAULT_OPERATION_LIMITS, **v}
+
     @root_validator
     @classmethod
     def check_consistency(cls, values):
@@ -40,4 +61,13 @@ class MeritRankSettings(BaseSettings):
                 raise ValueError('Ego warmup feature requires a Postgres DSN')
             if values.get("pg_edges_channel"):
                 raise ValueError('Postgres edges option (SQL LISTEN/NOTIFY) requires a Postgres DSN')
+            if values.get("score_export"):
+                raise ValueError('Scores export feature requires a Postgres DSN')
+        if (shard := values.get("cluster_shard")) is not None:
+            if shard not in values.get("cluster_shards", []):
+                raise ValueError('Cluster shard must be one of the cluster shards')
+            if values.get("zero_node"):
+                raise ValueError('Zero node is not supported in cluster mode')
+            if values.get("score_export"):
+                raise ValueError('Scores export is not supported in cluster mode')
         return values
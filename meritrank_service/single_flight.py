@@ -0,0 +1,103 @@
+import asyncio
+import inspect
+import threading
+import time
+from collections import Counter
+from contextlib import nullcontext
+from functools import partial
+from typing import Any, Callable, Hashable
+
+from meritrank_service.admission import AdmissionControl, DeadlineExceeded, current_deadline
+from meritrank_service.log import LOGGER
+from meritrank_service.profiling import profiled_thread
+
+LOGGER = LOGGER.getChild("single_flight")
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical computations. The first request for a key
+    (the "leader") starts the computation, while the requests for the same
+    key that arrive while it is in flight just wait for its result.
+    The computation keeps running as long as any of the requests waits for it.
+
+    Calculations in GravityRank are synchronous and not thread-safe, so those
+    run in a worker thread, one at a time, holding the rank lock. Meanwhile the event loop
+    keeps serving the other requests, and the identical ones join the flight.
+    Any other access to the rank that may calculate walks or modify the graph
+    must also go through run(), to be serialized with the computations.
+    Coroutine functions are awaited in the loop instead, and must use run() themselves.
+    If admission control is given, only the leader has to be admitted
+    to perform the computation, before it starts waiting for the rank lock.
+    """
+
+    def __init__(self, admission: AdmissionControl = None) -> None:
+        self.admission = admission
+        self.__lock = threading.Lock()
+        self.__flights: dict[Hashable, asyncio.Task] = {}
+        # Number of requests waiting for each in-flight computation
+        self.__waiters: dict[asyncio.Task, int] = {}
+        self.computed = Counter()
+        self.coalesced = Counter()
+
+    def __call_locked(self, fun: Callable, args, kwargs) -> Any:
+        # Don't wait for the lock past the deadline of the computation
+        timeout = -1
+        if (deadline := current_deadline.get()) is not None:
+            timeout = max(deadline - time.monotonic(), 0.0)
+        if not self.__lock.acquire(timeout=timeout):
+            raise DeadlineExceeded()
+        try:
+            with profiled_thread():
+                return fun(*args, **kwargs)
+        finally:
+            self.__lock.release()
+
+    async def run(self, fun: Callable, *args, **kwargs) -> Any:
+        """
+        Call the function in a worker thread, holding the rank lock.
+        The context (e.g. the request profile and deadline) is passed to the thread.
+        """
+        return await asyncio.to_thread(self.__call_locked, fun, args, kwargs)
+
+    async def __compute(self, operation: str, fun: Callable, args, kwargs) -> Any:
+        async with self.admission.admit(operation) if self.admission else nullcontext():
+            self.computed[operation] += 1
+            if inspect.iscoroutinefunction(fun):
+                return await fun(*args, **kwargs)
+            return await self.run(fun, *args, **kwargs)
+
+    def __on_flight_done(self, key, flight: asyncio.Task):
+        if self.__flights.get(key) is flight:
+            del self.__flights[key]
+        if not flight.cancelled():
+            # Mark the exception as retrieved, as there might be no one waiting for it
+            flight.exception()
+
+    async def do(self, key: tuple[Hashable, ...], fun: Callable, *args, **kwargs) -> Any:
+        # The first element of the key is the operation name, used for stats
+        operation = key[0]
+        if (flight := self.__flights.get(key)) is not None:
+            self.coalesced[operation] += 1
+            LOGGER.debug("Joining in-flight computation %s", key)
+        else:
+            # The computation runs in its own task, so cancelling the request that started it
+            # does not cancel the requests that joined. It is only cancelled when all of those leave.
+            flight = self.__flights[key] = asyncio.create_task(self.__compute(operation, fun, args, kwargs))
+            flight.add_done_callback(partial(self.__on_flight_done, key))
+
+        self.__waiters[flight] = self.__waiters.get(flight, 0) + 1
+        try:
+            return await asyncio.shield(flight)
+        finally:
+            self.__waiters[flight] -= 1
+            if not self.__waiters[flight]:
+                del self.__waiters[flight]
+                flight.cancel()
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {
+            operation: {"computed": self.computed[operation],
+                        "coalesced": self.coalesced[operation]}
+            for operation in self.computed | self.coalesced
+        }
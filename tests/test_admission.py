@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+import pytest
+
+from meritrank_service.admission import AdmissionControl, OperationLimit, Overloaded, DeadlineExceeded, \
+    check_deadline
+from meritrank_service.single_flight import SingleFlight
+
+
+def test_unlimited_operation_is_admitted():
+    async def run():
+        async with AdmissionControl({}).admit("anything"):
+            check_deadline()
+
+    asyncio.run(run())
+
+
+def test_queue_overflow_is_rejected():
+    admission = AdmissionControl({"op": OperationLimit(max_concurrent=1, max_queue=1, timeout=1.0)})
+    single_flight = SingleFlight(admission)
+
+    def compute():
+        # Blocks like the real computations do, without yielding to the loop
+        time.sleep(0.02)
+
+    async def run():
+        return await asyncio.gather(*(single_flight.do(("op", i), compute) for i in range(20)),
+                                    return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert results[:2] == [None, None]
+    assert all(isinstance(r, Overloaded) and r.status_code == 429 for r in results[2:])
+    assert admission.stats()["op"] == {"admitted": 2, "waiting": 0, "rejected": 18, "timed_out": 0}
+
+
+def test_queued_request_times_out():
+    admission = AdmissionControl({"op": OperationLimit(max_concurrent=1, max_queue=1, timeout=0.05)})
+    single_flight = SingleFlight(admission)
+
+    async def run():
+        return await asyncio.gather(single_flight.do(("op", 1), time.sleep, 0.2),
+                                    single_flight.do(("op", 2), time.sleep, 0.2),
+                                    return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert results[0] is None
+    assert isinstance(results[1], DeadlineExceeded)
+    assert admission.stats()["op"]["timed_out"] == 1
+
+
+def test_computation_is_aborted_after_deadline():
+    admission = AdmissionControl({"op": OperationLimit(timeout=0.01)})
+    single_flight = SingleFlight(admission)
+
+    def compute():
+        while True:
+            time.sleep(0.005)
+            check_deadline()
+
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(single_flight.do(("op",), compute))
+    assert admission.stats()["op"]["timed_out"] == 1
+
+
+def test_unlimited_operation_gets_default_deadline():
+    single_flight = SingleFlight(AdmissionControl({}, default_timeout=0.05))
+
+    async def run():
+        # The lookup can't get the rank lock while the computation holds it
+        computation = asyncio.create_task(single_flight.run(time.sleep, 0.3))
+        await asyncio.sleep(0.01)
+        with pytest.raises(DeadlineExceeded):
+            await single_flight.do(("node_score", "U1", "U2"), lambda: 1.0)
+        await computation
+
+    asyncio.run(run())
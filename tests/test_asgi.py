@@ -1,3 +1,4 @@
+import time
 from unittest.mock import Mock
 
 import pytest
@@ -5,6 +6,7 @@ from fastapi import FastAPI
 from fastapi.testclient import TestClient
 
 from meritrank_service.asgi import create_meritrank_app
+from meritrank_service.gravity_rank import GlobalRanking, GravityRank
 from meritrank_service.rest import Edge, MeritRankRestRoutes
 
 
@@ -50,3 +52,81 @@ def test_get_edge(mrank, rank_routes, client):
     response = client.get("/node_edges/0")
     assert response.status_code == 200
     assert response.json() == [Edge(src='a', dest='b', weight=1.0).dict()]
+
+
+def test_get_scores_and_metrics(mrank, rank_routes, client):
+    mrank.get_ranks = lambda *_, **__: {'1': 0.5}
+    response = client.get("/scores/0")
+    assert response.status_code == 200
+    assert response.json() == [{'ego': '0', 'node': '1', 'score': 0.5}]
+    response = client.get("/metrics")
+    assert response.json()["single_flight"] == {"ranks": {"computed": 1, "coalesced": 0}}
+
+
+def test_get_scores_formats(mrank, rank_routes, client):
+    mrank.get_ranks = lambda *_, **__: {'1': 0.5, '2': 0.25}
+    response = client.get("/scores/0", headers={"Accept": "application/vnd.meritrank.columnar+json"})
+    assert response.headers["content-type"] == "application/vnd.meritrank.columnar+json"
+    assert response.json() == {'ego': '0', 'nodes': ['1', '2'], 'scores': [0.5, 0.25]}
+    response = client.get("/scores/0", headers={"Accept": "application/x-ndjson"})
+    assert response.text == '{"node":"1","ego":"0","score":0.5}\n{"node":"2","ego":"0","score":0.25}\n'
+    assert client.get("/scores/0", headers={"Accept": "text/html"}).status_code == 406
+
+
+def test_get_global_ranking(mrank, rank_routes, client):
+    mrank.global_ranking = None
+    assert client.get("/global_ranking").status_code == 404
+
+    mrank.global_ranking = GlobalRanking(version=3, updated_at=0.0, ranks=[('B1', 0.7), ('B2', 0.3)])
+    response = client.get("/global_ranking", params={"offset": 1})
+    assert response.status_code == 200
+    assert response.headers["ETag"] == 'W/"3"'
+    assert response.json()["total"] == 2
+    assert response.json()["ranks"] == [{'node': 'B2', 'score': 0.3}]
+
+    response = client.get("/global_ranking", headers={"If-None-Match": '"3"'})
+    assert response.status_code == 304
+
+
+def test_put_zero_refreshes_in_background():
+    rank = GravityRank(graph={"U1": {"B1": {"weight": 1.0}, "U2": {"weight": 1.0}},
+                              "U2": {"B2": {"weight": 1.0}, "U1": {"weight": 1.0}}}, num_walks=100)
+    app = FastAPI()
+    app.include_router(MeritRankRestRoutes(rank).router)
+    with TestClient(app=app) as client:
+        response = client.put("/zero", params={"zero_node": "U0", "top_nodes_limit": 1})
+        assert response.status_code == 202
+        for _ in range(100):
+            if (response := client.get("/global_ranking")).status_code == 200:
+                break
+            time.sleep(0.05)
+        assert response.status_code == 200
+        assert response.json()["updated_at"].endswith("+00:00")
+        top_node = response.json()["ranks"][0]["node"]
+        assert [edge["dest"] for edge in client.get("/node_edges/U0").json()] == [top_node]
+
+
+def test_calculate_walk_count_limit(mrank):
+    app = FastAPI()
+    app.include_router(MeritRankRestRoutes(mrank, max_walk_count=100).router)
+    client = TestClient(app=app)
+    assert client.put("/calculate", params={"ego": "0", "count": 101}).status_code == 422
+    assert client.put("/calculate", params={"ego": "0", "count": 100}).status_code == 200
+    mrank.calculate.assert_called_once_with("0", num_walks=100)
+
+
+def test_put_graph_keeps_shared_rank():
+    rank = GravityRank(graph={"U1": {"U2": {"weight": 1.0}}}, num_walks=100)
+    rank.global_ranking = GlobalRanking(version=1, updated_at=0.0, ranks=[('B1', 1.0)])
+    listener = Mock()
+    rank.add_edge_listener(listener)
+    rank.calculate("U1")
+    app = FastAPI()
+    app.include_router(MeritRankRestRoutes(rank).router)
+    client = TestClient(app=app)
+    response = client.put("/graph", json=[{"src": "U1", "dest": "U3", "weight": 1.0}])
+    assert response.status_code == 200
+    listener.assert_called_once_with(None, None, None, {"U1"})
+    assert rank.egos == set()
+    assert client.get("/edge/U1/U3").json()["weight"] == 1.0
+    assert client.get("/global_ranking").status_code == 200
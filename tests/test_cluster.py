@@ -0,0 +1,139 @@
+import hashlib
+import json
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+from meritrank_service.cluster import HashRing, ClusterShard
+from meritrank_service.cluster_router import create_cluster_router_app, get_graphql_egos
+from meritrank_service.graphql import get_graphql_app
+from meritrank_service.gravity_rank import GravityRank
+from meritrank_service.rest import MeritRankRestRoutes
+
+SHARDS = ["http://shard1", "http://shard2"]
+
+
+def test_hash_ring():
+    ring = HashRing(SHARDS)
+    egos = [f"U{i}" for i in range(1000)]
+    owners = {ego: ring.owner(ego) for ego in egos}
+    assert owners == {ego: HashRing(SHARDS).owner(ego) for ego in egos}
+    assert 300 < list(owners.values()).count(SHARDS[0]) < 700
+
+    # Adding a shard only moves egos to the new shard
+    bigger_ring = HashRing(SHARDS + ["http://shard3"])
+    assert all(bigger_ring.owner(ego) in (owner, "http://shard3") for ego, owner in owners.items())
+
+
+def test_get_graphql_egos():
+    assert get_graphql_egos({"query": '{ scores(ego: "U1") { node } edge(src: "U1", dest: "U2") { src } }'}) == \
+           (False, {"U1"})
+    assert get_graphql_egos({"query": 'query Q($e: String!) { usersStats(ego: $e) { node } }',
+                             "variables": {"e": "U2"}}) == (False, {"U2"})
+    assert get_graphql_egos({"query": 'mutation { putEdge(src: "U1", dest: "U2", weight: 1.0) { src } }'}) == \
+           (True, set())
+
+
+@pytest.fixture()
+def cluster(monkeypatch):
+    ring = HashRing(SHARDS)
+    # Pick two users owned by different shards
+    u1 = next(f"U{i}" for i in range(100) if ring.owner(f"U{i}") == SHARDS[0])
+    u2 = next(f"U{i}" for i in range(100) if ring.owner(f"U{i}") == SHARDS[1])
+    graph = {u1: {u2: {"weight": 1.0}}, u2: {u1: {"weight": 1.0}}}
+
+    clients, ranks = {}, {}
+    for shard in SHARDS:
+        cluster_shard = ClusterShard(ring, shard, clients)
+        rank = ranks[shard] = GravityRank(graph=graph, owns_ego=cluster_shard.owns_ego, num_walks=100)
+        app = FastAPI()
+        app.include_router(MeritRankRestRoutes(rank).router)
+        app.include_router(get_graphql_app(rank, cluster=cluster_shard), prefix="/graphql")
+        clients[shard] = httpx.AsyncClient(app=app, base_url=shard)
+
+    monkeypatch.setenv("CLUSTER_SHARDS", '["http://shard1", "http://shard2"]')
+    return TestClient(app=create_cluster_router_app(clients)), ranks, u1, u2
+
+
+def test_scores_are_calculated_by_owner(cluster):
+    client, ranks, u1, u2 = cluster
+    response = client.get(f"/scores/{u1}")
+    assert response.status_code == 200
+    assert {s["node"] for s in response.json()} == {u1, u2}
+    assert client.get(f"/node_score/{u2}/{u1}").status_code == 200
+    assert ranks[SHARDS[0]].egos == {u1}
+    assert ranks[SHARDS[1]].egos == {u2}
+
+
+def test_non_owned_ego_is_rejected_by_shard(cluster):
+    _, ranks, u1, u2 = cluster
+    with pytest.raises(Exception) as e:
+        ranks[SHARDS[1]].get_ranks(u1)
+    assert e.value.status_code == 421
+
+
+def test_edges_are_sent_to_all_shards(cluster):
+    client, ranks, u1, u2 = cluster
+    response = client.put("/edge", json={"src": u1, "dest": "B1", "weight": 1.0})
+    assert response.status_code == 200
+    assert all(rank.get_edge(u1, "B1") == 1.0 for rank in ranks.values())
+
+
+def test_users_stats_gets_reverse_scores_from_other_shards(cluster):
+    client, ranks, u1, u2 = cluster
+    response = client.post("/graphql", json={"query": f'{{ usersStats(ego: "{u1}") {{ node nodeScore egoScore }} }}'})
+    stats = {s["node"]: s for s in response.json()["data"]["usersStats"]}
+    assert stats[u2]["egoScore"] > 0.0
+    assert ranks[SHARDS[0]].egos == {u1}
+    assert ranks[SHARDS[1]].egos == {u2}
+
+    response = client.post("/graphql", json={"query": f'{{ a: scores(ego: "{u1}") {{ node }} '
+                                                      f'b: scores(ego: "{u2}") {{ node }} }}'})
+    assert response.status_code == 400
+
+
+def test_persisted_query_is_expanded_by_router(cluster):
+    client, ranks, u1, u2 = cluster
+    query = f'{{ scores(ego: "{u2}") {{ node }} }}'
+    extensions = {"persistedQuery": {"version": 1, "sha256Hash": hashlib.sha256(query.encode()).hexdigest()}}
+    response = client.post("/graphql", json={"extensions": extensions})
+    assert response.json()["errors"][0]["extensions"]["code"] == "PERSISTED_QUERY_NOT_FOUND"
+
+    client.post("/graphql", json={"query": query, "extensions": extensions})
+    for _ in range(4):
+        response = client.post("/graphql", json={"extensions": extensions})
+        assert {s["node"] for s in response.json()["data"]["scores"]} == {u1, u2}
+    response = client.get("/graphql", params={"extensions": json.dumps(extensions)})
+    assert {s["node"] for s in response.json()["data"]["scores"]} == {u1, u2}
+    assert ranks[SHARDS[0]].egos == set()
+
+
+def test_subscriptions_are_rejected_by_router(cluster):
+    client, *_ = cluster
+    with pytest.raises(WebSocketDisconnect) as e:
+        with client.websocket_connect("/graphql", ["graphql-transport-ws"]):
+            pass
+    assert e.value.code == 1008
+
+
+def test_global_ranking_is_not_supported(cluster):
+    client, *_ = cluster
+    assert client.put("/zero", params={"zero_node": "U0"}).status_code == 501
+
+
+def test_unavailable_shard_is_reported(cluster):
+    client, ranks, u1, u2 = cluster
+
+    def fail(request):
+        raise httpx.ConnectError("Connection refused", request=request)
+
+    shard = ClusterShard(HashRing(SHARDS), SHARDS[0], {SHARDS[1]: httpx.AsyncClient(
+        transport=httpx.MockTransport(fail), base_url=SHARDS[1])})
+    app = FastAPI()
+    app.include_router(get_graphql_app(ranks[SHARDS[0]], cluster=shard), prefix="/graphql")
+    response = TestClient(app=app).post("/graphql", json={"query": f'{{ usersStats(ego: "{u1}") {{ node }} }}'})
+    assert response.status_code == 503
+    assert response.json()["errors"][0]["message"] == f"Shard {SHARDS[1]} is unavailable, try again later"
@@ -0,0 +1,124 @@
+import hashlib
+import json
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from meritrank_service.admission import AdmissionControl, OperationLimit
+from meritrank_service.graphql import get_graphql_app
+from meritrank_service.gravity_rank import GravityRank
+from meritrank_service.score_notifier import ScoreChangeNotifier
+from meritrank_service.single_flight import SingleFlight
+
+QUERY = '{ edges(src: "U1") { src dest weight } }'
+QUERY_HASH = hashlib.sha256(QUERY.encode()).hexdigest()
+
+
+@pytest.fixture()
+def client():
+    rank = GravityRank(graph={"U1": {"U2": {"weight": 1.0}}, "U2": {"U1": {"weight": 1.0}}})
+    app = FastAPI()
+    app.include_router(get_graphql_app(rank), prefix="/graphql")
+    return TestClient(app=app)
+
+
+def persisted_query_extensions(sha256_hash):
+    return {"persistedQuery": {"version": 1, "sha256Hash": sha256_hash}}
+
+
+def test_query(client):
+    for _ in range(2):
+        response = client.post("/graphql", json={"query": QUERY})
+        assert response.json() == {"data": {"edges": [{"src": "U1", "dest": "U2", "weight": 1.0}]}}
+
+
+def test_scores_columns(client):
+    response = client.post("/graphql", json={"query": '{ scoresColumns(ego: "U1") { ego nodes scores } }'})
+    columns = response.json()["data"]["scoresColumns"]
+    assert columns["ego"] == "U1"
+    assert set(columns["nodes"]) == {"U1", "U2"}
+    assert len(columns["scores"]) == 2
+
+
+def test_global_ranking_paging_is_validated(client):
+    response = client.post("/graphql", json={"query": '{ globalRanking(offset: -1) { version } }'})
+    assert response.json()["errors"][0]["message"] == "Offset must not be negative"
+    response = client.post("/graphql", json={"query": '{ globalRanking(limit: 0) { version } }'})
+    assert response.json()["errors"][0]["message"] == "Limit must be positive"
+
+
+def test_persisted_query(client):
+    response = client.post("/graphql", json={"extensions": persisted_query_extensions(QUERY_HASH)})
+    assert response.json()["errors"][0]["extensions"]["code"] == "PERSISTED_QUERY_NOT_FOUND"
+
+    response = client.post("/graphql", json={"query": QUERY, "extensions": persisted_query_extensions(QUERY_HASH)})
+    assert response.json()["data"]["edges"][0]["dest"] == "U2"
+
+    response = client.post("/graphql", json={"extensions": persisted_query_extensions(QUERY_HASH)})
+    assert response.json()["data"]["edges"][0]["dest"] == "U2"
+
+
+def test_request_body_is_decoded_once(mocker):
+    rank = GravityRank(graph={"U1": {"U2": {"weight": 1.0}}, "U2": {"U1": {"weight": 1.0}}})
+    graphql_app = get_graphql_app(rank)
+    parse_json = mocker.spy(graphql_app, "parse_json")
+    app = FastAPI()
+    app.include_router(graphql_app, prefix="/graphql")
+    response = TestClient(app=app).post(
+        "/graphql", json={"query": QUERY, "extensions": persisted_query_extensions(QUERY_HASH)})
+    assert response.json()["data"]["edges"][0]["dest"] == "U2"
+    assert parse_json.call_count == 1
+
+
+def test_persisted_query_hash_mismatch(client):
+    response = client.post("/graphql", json={"query": QUERY, "extensions": persisted_query_extensions("abc")})
+    assert response.json()["errors"][0]["extensions"]["code"] == "INVALID_PERSISTED_QUERY_HASH"
+
+
+def test_persisted_query_via_get(client):
+    extensions = json.dumps(persisted_query_extensions(QUERY_HASH))
+    client.get("/graphql", params={"query": QUERY, "extensions": extensions})
+    response = client.get("/graphql", params={"extensions": extensions})
+    assert response.json()["data"]["edges"][0]["dest"] == "U2"
+
+
+def test_overloaded_request_status():
+    rank = GravityRank(graph={"U1": {"U2": {"weight": 1.0}}, "U2": {"U1": {"weight": 1.0}}})
+    admission = AdmissionControl({"users_stats": OperationLimit(timeout=-1.0)})
+    app = FastAPI()
+    app.include_router(get_graphql_app(rank, SingleFlight(admission)), prefix="/graphql")
+    response = TestClient(app=app).post("/graphql", json={"query": '{ usersStats(ego: "U1") { node } }'})
+    assert response.status_code == 503
+    assert response.json()["errors"][0]["message"] == "Request deadline exceeded, try again later"
+
+
+def test_score_updates_need_notifier(client):
+    with client.websocket_connect("/graphql", ["graphql-transport-ws"]) as ws:
+        ws.send_json({"type": "connection_init"})
+        ws.receive_json()
+        ws.send_json({"id": "1", "type": "subscribe", "payload": {
+            "query": 'subscription { scoreUpdates(ego: "U1") { removed } }'}})
+        assert ws.receive_json()["payload"][0]["message"] == "Score updates are not enabled"
+
+
+def test_score_updates_subscription():
+    rank = GravityRank(graph={"U1": {"U2": {"weight": 1.0}}, "U2": {"U1": {"weight": 1.0}}}, num_walks=1000)
+    app = FastAPI()
+    app.include_router(get_graphql_app(rank, score_notifier=ScoreChangeNotifier(rank, debounce=0.01)),
+                       prefix="/graphql")
+    with TestClient(app=app) as client, \
+            client.websocket_connect("/graphql", ["graphql-transport-ws"]) as ws:
+        ws.send_json({"type": "connection_init"})
+        assert ws.receive_json()["type"] == "connection_ack"
+        ws.send_json({"id": "1", "type": "subscribe", "payload": {
+            "query": 'subscription { scoreUpdates(ego: "U1") { scores { node } removed } }'}})
+        update = ws.receive_json()["payload"]["data"]["scoreUpdates"]
+        assert {s["node"] for s in update["scores"]} == {"U1", "U2"}
+
+        # Edge not affecting U1 walks produces no update
+        client.post("/graphql", json={"query": 'mutation { putEdge(src: "U3", dest: "U1", weight: 1.0) { src } }'})
+        client.post("/graphql", json={"query": 'mutation { putEdge(src: "U2", dest: "U3", weight: 1.0) { src } }'})
+        update = ws.receive_json()["payload"]["data"]["scoreUpdates"]
+        assert "U3" in {s["node"] for s in update["scores"]}
+        ws.send_json({"id": "1", "type": "complete"})
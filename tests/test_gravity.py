@@ -1,7 +1,12 @@
+import asyncio
+import time
+
 import pytest
 
 import networkx as nx
+from meritrank_service.admission import DeadlineExceeded
 from meritrank_service.gravity_rank import GravityRank
+from meritrank_service.single_flight import SingleFlight
 
 
 @pytest.fixture()
@@ -69,3 +74,75 @@ def test_global_ranks(simple_gravity_graph):
 
 def test_users_stats(simple_gravity_graph):
     g = GravityRank(graph=simple_gravity_graph)
+
+
+def test_edge_listener_gets_affected_egos(simple_gravity_graph):
+    g = GravityRank(graph=simple_gravity_graph)
+    g.calculate("U1", num_walks=100)
+    g.calculate("U3", num_walks=100)
+    calls = []
+    g.add_edge_listener(lambda *args: calls.append(args))
+    g.add_edge("U2", "B1", 1.0)
+    assert calls == [("U2", "B1", 1.0, {"U1"})]
+    # Putting the same edge again changes nothing
+    g.add_edge("U2", "B1", 1.0)
+    assert len(calls) == 1
+
+
+def test_global_ranking_version(simple_gravity_graph):
+    g = GravityRank(graph=simple_gravity_graph)
+    assert g.global_ranking is None
+    ranking = g.refresh_global_ranking()
+    assert ranking.version == 1
+    assert [node for node, _ in ranking.ranks] == [node for node, _ in g.get_top_beacons_global()]
+    asyncio.run(g.refresh_zero_opinion(SingleFlight(), "U0", top_nodes_limit=1))
+    assert g.get_node_edges("U0") == [("U0", ranking.ranks[0][0], ranking.ranks[0][1])]
+
+
+def test_aborted_zero_refresh_restores_zero_edges(simple_gravity_graph, mocker):
+    g = GravityRank(graph=simple_gravity_graph)
+    asyncio.run(g.refresh_zero_opinion(SingleFlight(), "U0", top_nodes_limit=1))
+    zero_edges = g.get_node_edges("U0")
+    mocker.patch.object(g, "rank_global_beacons", side_effect=DeadlineExceeded())
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(g.refresh_zero_opinion(SingleFlight(), "U0", top_nodes_limit=1))
+    assert g.get_node_edges("U0") == zero_edges
+
+
+def test_zero_refresh_does_not_hold_rank_lock(simple_gravity_graph, mocker):
+    g = GravityRank(graph=simple_gravity_graph, num_walks=100)
+    g.calculate("U1")
+    rank_global_beacons = g.rank_global_beacons
+
+    def slow_rank_global_beacons(reduced_graph):
+        time.sleep(0.5)
+        return rank_global_beacons(reduced_graph)
+
+    mocker.patch.object(g, "rank_global_beacons", side_effect=slow_rank_global_beacons)
+
+    async def run():
+        sf = SingleFlight()
+        refresh = asyncio.create_task(g.refresh_zero_opinion(sf, "U0", top_nodes_limit=1))
+        await asyncio.sleep(0.2)
+        start = time.monotonic()
+        await sf.run(g.get_node_score, "U1", "U2")
+        lookup_time = time.monotonic() - start
+        await refresh
+        return lookup_time
+
+    assert asyncio.run(run()) < 0.2
+    assert g.global_ranking is not None
+
+
+def test_zero_heartbeat_survives_failed_refresh(simple_gravity_graph, mocker):
+    g = GravityRank(graph=simple_gravity_graph, num_walks=100)
+    refresh = mocker.patch.object(g, "refresh_zero_opinion",
+                                  side_effect=[DeadlineExceeded(), RuntimeError("boom"), None, None])
+
+    async def run():
+        heartbeat = asyncio.create_task(g.zero_opinion_heartbeat(SingleFlight(), "U0", 1, 0.01))
+        await asyncio.sleep(0.1)
+        heartbeat.cancel()
+
+    asyncio.run(run())
+    assert refresh.call_count >= 3
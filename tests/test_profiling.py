@@ -0,0 +1,78 @@
+import marshal
+import time
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from meritrank_service.graphql import get_graphql_app
+from meritrank_service.gravity_rank import GravityRank
+from meritrank_service.profiling import Profiler, ProfilingMiddleware, stage, NULL_STAGE
+from meritrank_service.rest import MeritRankRestRoutes
+
+
+@pytest.fixture()
+def client():
+    rank = GravityRank(graph={"U1": {"U2": {"weight": 1.0}}, "U2": {"U1": {"weight": 1.0}}}, num_walks=100)
+    profiler = Profiler()
+    app = FastAPI()
+    app.add_middleware(ProfilingMiddleware, profiler=profiler)
+    app.include_router(MeritRankRestRoutes(rank, profiler=profiler).router)
+    app.include_router(get_graphql_app(rank), prefix="/graphql")
+    with TestClient(app=app) as client:
+        yield client
+
+
+def test_stage_is_noop_outside_profiled_request():
+    assert stage("anything") is NULL_STAGE
+
+
+def test_requests_are_not_profiled_by_default(client):
+    response = client.get("/scores/U1")
+    assert "server-timing" not in response.headers
+    assert client.get("/profiling/requests").json() == []
+
+
+def test_profile_header(client):
+    response = client.get("/scores/U1", headers={"X-MeritRank-Profile": "1"})
+    timings = response.headers["server-timing"]
+    assert "walks;dur=" in timings
+    assert "ranks;dur=" in timings
+    assert "total;dur=" in timings
+
+    response = client.post("/graphql", headers={"X-MeritRank-Profile": "1"},
+                           json={"query": '{ gravityGraph(ego: "U1", focus: "U2") { edges { src } } }'})
+    assert "gravity_graph.path;dur=" in response.headers["server-timing"]
+    assert "graphql.parse;dur=" in response.headers["server-timing"]
+
+    profiles = client.get("/profiling/requests").json()
+    assert [p["path"] for p in profiles] == ["/scores/U1", "/graphql"]
+    assert profiles[0]["stages"]["walks"]["count"] == 1
+    # The streamed response body is encoded after the headers are sent
+    assert "rest.build" in profiles[0]["stages"]
+
+
+def test_enable_profiling(client):
+    client.put("/profiling", params={"enabled": True})
+    assert "server-timing" in client.get("/scores/U1").headers
+    client.put("/profiling", params={"enabled": False})
+    assert "server-timing" not in client.get("/scores/U1").headers
+
+
+@pytest.mark.parametrize("mode", ["sample", "cprofile"])
+def test_capture(client, mode):
+    assert client.get("/profiling/capture").status_code == 404
+    assert client.put("/profiling/capture", params={"duration": 1.0, "mode": mode}).status_code == 202
+    assert client.put("/profiling/capture", params={"duration": 1.0, "mode": mode}).status_code == 409
+    # The walks are calculated in a worker thread
+    client.put("/calculate", params={"ego": "U2", "count": 5000})
+    while (response := client.get("/profiling/capture")).status_code == 409:
+        time.sleep(0.05)
+    assert response.status_code == 200
+    if mode == "cprofile":
+        stats = marshal.loads(response.content)
+        assert any(filename.endswith("gravity_rank.py") and function == "calculate"
+                   for filename, _, function in stats)
+    else:
+        assert all(line.rsplit(" ", 1)[1].isdigit() for line in response.text.splitlines())
+        assert "calculate (gravity_rank.py:" in response.text
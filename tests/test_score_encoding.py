@@ -0,0 +1,40 @@
+import json
+
+import pytest
+
+from meritrank_service.score_encoding import negotiate_media_type, encode_scores, JSON, NDJSON, \
+    COLUMNAR_JSON, MSGPACK
+
+RANKS = {"U1": 0.5, "U2": 0.25, "B1": 0.125, "C1": 0.125, "U3": 0.0625}
+
+
+@pytest.mark.parametrize("accept, media_type", [
+    (None, JSON),
+    ("*/*", JSON),
+    ("text/html, application/x-ndjson", NDJSON),
+    ("application/json;q=0.5, application/vnd.meritrank.columnar+json", COLUMNAR_JSON),
+    ("application/msgpack;q=0, application/json", JSON),
+    ("text/html", None),
+])
+def test_negotiate_media_type(accept, media_type):
+    assert negotiate_media_type(accept) == media_type
+
+
+@pytest.mark.parametrize("ranks", [RANKS, {}])
+def test_encode_scores(ranks):
+    rows = [{"node": n, "ego": "U0", "score": s} for n, s in ranks.items()]
+    columns = {"ego": "U0", "nodes": list(ranks), "scores": list(ranks.values())}
+
+    def encode(media_type):
+        return b"".join(encode_scores(media_type, "U0", ranks, chunk_size=2))
+
+    assert json.loads(encode(JSON)) == rows
+    assert [json.loads(line) for line in encode(NDJSON).splitlines()] == rows
+    assert json.loads(encode(COLUMNAR_JSON)) == columns
+
+
+def test_encode_scores_msgpack():
+    msgpack = pytest.importorskip("msgpack")
+    assert negotiate_media_type("application/x-msgpack") == MSGPACK
+    columns = {"ego": "U0", "nodes": list(RANKS), "scores": list(RANKS.values())}
+    assert msgpack.unpackb(b"".join(encode_scores(MSGPACK, "U0", RANKS, chunk_size=2))) == columns
@@ -0,0 +1,48 @@
+import asyncio
+
+from meritrank_service.gravity_rank import GlobalRanking, GravityRank
+from meritrank_service.postgres_scores_exporter import PostgresScoresExporter, rows_to_csv
+from meritrank_service.single_flight import SingleFlight
+
+
+def test_rows_to_csv():
+    assert rows_to_csv([("U1", "U,2", 0.5)]).read() == 'U1,"U,2",0.5\r\n'
+
+
+def test_changed_egos_tracking():
+    g = GravityRank(graph={"U1": {"U2": {"weight": 1.0}}, "U2": {"U1": {"weight": 1.0}}})
+    exporter = PostgresScoresExporter(g, SingleFlight(), "postgres://localhost/none")
+    g.calculate("U1", num_walks=100)
+    # Newly calculated egos are always exported
+    assert exporter.pop_changed_egos() == {"U1"}
+
+    # The export does not calculate new egos, so U2 is only in the users stats after it is calculated
+    scores_rows, stats_rows = asyncio.run(exporter.collect_egos_rows(["U1", "U2"]))
+    assert {node for _, node, _ in scores_rows} == {"U1", "U2"}
+    assert {node for _, node, _, _ in stats_rows} == {"U1"}
+    assert g.egos == {"U1"}
+    g.calculate("U2", num_walks=100)
+    scores_rows, stats_rows = asyncio.run(exporter.collect_egos_rows(["U1"]))
+    assert {node for _, node, _, _ in stats_rows} == {"U1", "U2"}
+
+    g.add_edge("U2", "U3", 1.0)
+    assert "U1" in exporter.pop_changed_egos()
+
+
+def test_global_ranking_is_exported_without_changed_egos(mocker):
+    g = GravityRank(graph={"U1": {"B1": {"weight": 1.0}}})
+    exporter = PostgresScoresExporter(g, SingleFlight(), "postgres://localhost/none")
+    execute = mocker.patch.object(exporter, "_PostgresScoresExporter__execute_in_transaction")
+    g.global_ranking = GlobalRanking(version=1, updated_at=0.0, ranks=[("B1", 1.0)])
+
+    asyncio.run(exporter.export())
+    assert execute.call_count == 1
+    assert execute.call_args.args[1] == [(0, "B1", 1.0)]
+
+    # The same version is not rewritten
+    asyncio.run(exporter.export())
+    assert execute.call_count == 1
+
+    g.global_ranking = GlobalRanking(version=2, updated_at=1.0, ranks=[("B1", 0.5)])
+    asyncio.run(exporter.export())
+    assert execute.call_count == 2
@@ -0,0 +1,101 @@
+import asyncio
+import time
+
+from meritrank_service.single_flight import SingleFlight
+
+
+def test_concurrent_calls_are_coalesced():
+    calls = []
+
+    def compute(x):
+        calls.append(x)
+        return x * 2
+
+    async def run():
+        sf = SingleFlight()
+        results = await asyncio.gather(*(sf.do(("double", 1), compute, 1) for _ in range(5)),
+                                       sf.do(("double", 2), compute, 2))
+        return sf, results
+
+    sf, results = asyncio.run(run())
+    assert results == [2, 2, 2, 2, 2, 4]
+    assert calls == [1, 2]
+    assert sf.stats() == {"double": {"computed": 2, "coalesced": 4}}
+
+
+def test_exception_is_shared():
+    def fail():
+        raise ValueError("boom")
+
+    async def run():
+        sf = SingleFlight()
+        return await asyncio.gather(sf.do(("fail",), fail), sf.do(("fail",), fail), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, ValueError) for r in results)
+
+
+def test_sequential_calls_are_not_coalesced():
+    sf = SingleFlight()
+    asyncio.run(sf.do(("op",), lambda: 1))
+    asyncio.run(sf.do(("op",), lambda: 1))
+    assert sf.stats() == {"op": {"computed": 2, "coalesced": 0}}
+
+
+def test_requests_arriving_during_blocking_computation_are_coalesced():
+    def compute():
+        time.sleep(0.05)
+        return 1
+
+    async def request(sf, ticks):
+        for _ in range(ticks):
+            await asyncio.sleep(0)
+        return await sf.do(("op",), compute)
+
+    async def run():
+        sf = SingleFlight()
+        return sf, await asyncio.gather(*(request(sf, i % 4) for i in range(20)))
+
+    sf, results = asyncio.run(run())
+    assert results == [1] * 20
+    assert sf.stats() == {"op": {"computed": 1, "coalesced": 19}}
+
+
+def test_cancelled_leader_does_not_cancel_joiners():
+    def compute():
+        time.sleep(0.05)
+        return 1
+
+    async def run():
+        sf = SingleFlight()
+        leader = asyncio.create_task(sf.do(("ranks", "U1", 100), compute))
+        await asyncio.sleep(0)
+        joiner = asyncio.create_task(sf.do(("ranks", "U1", 100), compute))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return leader, await joiner
+
+    leader, result = asyncio.run(run())
+    assert leader.cancelled()
+    assert result == 1
+
+
+def test_computation_is_cancelled_when_all_requests_leave():
+    started = []
+
+    async def compute():
+        started.append(True)
+        await asyncio.sleep(10)
+
+    async def run():
+        sf = SingleFlight()
+        requests = [asyncio.create_task(sf.do(("op",), compute)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for request in requests:
+            request.cancel()
+        await asyncio.gather(*requests, return_exceptions=True)
+        # The key is free for a new computation
+        return await asyncio.wait_for(sf.do(("op",), lambda: 1), 1)
+
+    assert asyncio.run(run()) == 1
+    assert started == [True]